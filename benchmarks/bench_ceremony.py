@@ -0,0 +1,157 @@
+"""Run the real generate() and recover() paths headlessly over a matrix of
+users x accounts x threshold and record wall time, CPU time and peak RSS.
+Run from the repository root with "python -m benchmarks.bench_ceremony".
+
+Every configuration runs in a fresh process so peak RSS is not carried
+over from earlier runs. Prompts are answered by a script instead of a
+person and all terminal output is discarded.
+
+Usage:
+    bench_ceremony [--users=<list>] [--accounts=<list>] [--thresholds=<list>] [--parallel | --prefetch] [--output=<backend>] [--json=<file>]
+
+Options:
+    --users=<list>       Comma separated numbers of users [default: 2,5]
+    --accounts=<list>    Comma separated numbers of accounts per user [default: 1,10]
+    --thresholds=<list>  Comma separated key thresholds [default: 2]
+    --parallel           Run generate() with --parallel
+    --prefetch           Run generate() with --prefetch
+    --output=<backend>   Stage bundles in a temporary directory or in memory [default: directory]
+    --json=<file>        Also write the results to a JSON file
+"""
+from __future__ import print_function
+
+import itertools
+import json
+import os
+import resource
+import sys
+import time
+
+from multiprocessing import Process, Queue
+
+import mock
+
+from docopt import docopt
+
+from failsafe import failsafe
+
+class ScriptedInput(object):
+    """Stand-in for failsafe's _get_input that answers prompts from a script"""
+    def __init__(self, user_index=None, number_of_accounts=None, shards=None):
+        self.user_index = user_index
+        self.number_of_accounts = number_of_accounts
+        self.shards = list(shards or [])
+        self.words = []
+
+    def __call__(self, prompt, input_type=None, default=None, secure=False):
+        if prompt.startswith('Enter the indexes of the users'):
+            return str(self.user_index + 1)
+        if prompt.startswith('Enter number of accounts'):
+            return self.number_of_accounts
+        if prompt.startswith('Enter encrypted shard'):
+            encrypted_shard, passphrase = self.shards.pop(0)
+            self.words = passphrase.split()
+            return encrypted_shard
+        if prompt.startswith('Enter word #'):
+            return self.words.pop(0)
+        return ''
+
+def _measure(func):
+    start_times = os.times()
+    start = time.time()
+    func()
+    wall = time.time() - start
+    end_times = os.times()
+
+    # user + sys for this process and any worker processes it waited on
+    cpu = sum(end_times[:4]) - sum(start_times[:4])
+    return wall, cpu
+
+def _peak_rss_kb():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def _run_configuration(config, results):
+    users, accounts, threshold, parallel, prefetch, output = config
+    bundles = []
+    present_bundle = failsafe._present_bundle
+
+    def record_bundle(bundle):
+        bundles.append(json.loads(bundle.output.read(bundle.filename)))
+        present_bundle(bundle)
+
+    result = {'users': users,
+              'accounts': accounts,
+              'threshold': threshold,
+              }
+    with open(os.devnull, 'w') as devnull, \
+            mock.patch.object(sys, 'stdout', devnull), \
+            mock.patch('failsafe.failsafe._print'), \
+            mock.patch('failsafe.failsafe._present_bundle', side_effect=record_bundle):
+        with mock.patch('failsafe.failsafe._get_input', ScriptedInput()):
+            result['generate_wall_seconds'], result['generate_cpu_seconds'] = _measure(
+                lambda: failsafe.generate(number_of_users=users,
+                                          number_of_accounts=accounts,
+                                          key_threshold=threshold,
+                                          extra_entropy='benchmark',
+                                          parallel=parallel,
+                                          prefetch=prefetch,
+                                          options=failsafe.BundleOptions(output=output)))
+
+        if users > 1:
+            # Rebuild the last user's bundle from the first threshold shards
+            shards = [(str(bundle['encrypted_shard']), str(bundle['passphrase'])) for bundle in bundles[:threshold]]
+            scripted_input = ScriptedInput(user_index=users - 1,
+                                           number_of_accounts=accounts,
+                                           shards=shards)
+            with mock.patch('failsafe.failsafe._get_input', scripted_input):
+                result['recover_wall_seconds'], result['recover_cpu_seconds'] = _measure(failsafe.recover)
+
+    result['peak_rss_kb'] = _peak_rss_kb()
+    results.put(result)
+
+def run_configuration(config):
+    results = Queue()
+    process = Process(target=_run_configuration, args=(config, results))
+    process.start()
+    process.join()
+    if process.exitcode:
+        raise RuntimeError('Benchmark failed for users={} accounts={} threshold={}'.format(*config[:3]))
+    return results.get()
+
+def _int_list(value):
+    return [int(x) for x in value.split(',')]
+
+def main():
+    arguments = docopt(__doc__)
+    matrix = [(users, accounts, threshold, arguments['--parallel'], arguments['--prefetch'], arguments['--output'])
+              for users, accounts, threshold in itertools.product(_int_list(arguments['--users']),
+                                                                  _int_list(arguments['--accounts']),
+                                                                  _int_list(arguments['--thresholds']))
+              if threshold <= users]
+
+    columns = (('users', 'users'),
+               ('accounts', 'accounts'),
+               ('threshold', 'threshold'),
+               ('generate_wall_seconds', 'gen wall s'),
+               ('generate_cpu_seconds', 'gen cpu s'),
+               ('recover_wall_seconds', 'rec wall s'),
+               ('recover_cpu_seconds', 'rec cpu s'),
+               ('peak_rss_kb', 'peak rss kb'),
+               )
+    print(' '.join('{:>12}'.format(label) for column, label in columns))
+
+    results = []
+    for config in matrix:
+        result = run_configuration(config)
+        results.append(result)
+        print(' '.join('{:>12.3f}'.format(result[column]) if isinstance(result.get(column), float)
+                       else '{:>12}'.format(result.get(column, '-'))
+                       for column, label in columns))
+
+    if arguments['--json']:
+        with open(arguments['--json'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
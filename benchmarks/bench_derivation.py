@@ -0,0 +1,53 @@
+"""Compare batch account derivation with the per-account Wallet path.
+Run from the repository root with "python -m benchmarks.bench_derivation".
+
+Usage:
+    bench_derivation [--accounts=<n>] [--repeat=<n>]
+
+Options:
+    --accounts=<n>  Number of accounts to derive [default: 1000]
+    --repeat=<n>    Number of timed runs per path [default: 3]
+"""
+from __future__ import print_function
+
+import timeit
+
+from docopt import docopt
+from bitmerchant.wallet import Wallet
+
+from failsafe.derivation import iter_accounts
+
+def per_account(user_key, number_of_accounts):
+    for idx in range(number_of_accounts):
+        child = user_key.get_child(0).get_child(idx)
+        child.export_to_wif()
+        child.to_address()
+
+def batch(user_key, number_of_accounts):
+    for account in iter_accounts(user_key, 0, number_of_accounts):
+        pass
+
+def main():
+    arguments = docopt(__doc__)
+    number_of_accounts = int(arguments['--accounts'])
+    repeat = int(arguments['--repeat'])
+
+    master_wallet = Wallet.new_random_wallet()
+
+    results = {}
+    for name, func in (('per-account', per_account), ('batch', batch)):
+        # A fresh user key per run keeps bitmerchant's get_child cache from
+        # carrying results over between runs
+        timings = [timeit.timeit(lambda: func(master_wallet.get_child(run, is_prime=True),
+                                              number_of_accounts),
+                                 number=1)
+                   for run in range(repeat)]
+        results[name] = min(timings)
+        print('{:<12} {:>10.3f}s  ({:.2f}ms/account)'.format(name,
+                                                             results[name],
+                                                             1000 * results[name] / number_of_accounts))
+
+    print('speedup      {:>10.2f}x'.format(results['per-account'] / results['batch']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import hmac
+import struct
+
+from binascii import hexlify, unhexlify
+from collections import namedtuple
+from hashlib import sha512
+
+from ecdsa import SECP256k1
+from bitmerchant.network import BitcoinMainNet
+from bitmerchant.wallet import Wallet
+from bitmerchant.wallet.bip32 import InvalidPrivateKeyError
+from bitmerchant.wallet.keys import PrivateKey
+
+from .profiling import stage
+
+EXTERNAL_CHAIN = 0
+HARDENED_BOUNDARY = 0x80000000
+
+Account = namedtuple('Account', ['index', 'wif', 'address'])
+
+class AccountDeriver(object):
+    """Derive the non-hardened children of m/user_index'/chain in bulk.
+
+    The chain node, its compressed public key and its chain code are
+    computed once. Each account then only costs one HMAC-SHA512 and the
+    point multiplication needed for its address.
+    """
+    def __init__(self, user_key, chain=EXTERNAL_CHAIN):
+        chain_key = user_key.get_child(chain) # m/user_index'/chain
+        self.network = chain_key.network
+        self._chain_code = unhexlify(chain_key.chain_code)
+        self._public_key = unhexlify(chain_key.get_public_key_hex())
+        self._exponent = int(chain_key.get_private_key_hex(), 16)
+
+    def private_key(self, index):
+        if index < 0 or index >= HARDENED_BOUNDARY:
+            raise ValueError('Invalid account index {}'.format(index))
+
+        I = hmac.new(self._chain_code,
+                     msg=self._public_key + struct.pack('>L', index),
+                     digestmod=sha512).digest()
+        I_L = int(hexlify(I[:32]), 16)
+        if I_L >= SECP256k1.order:
+            raise InvalidPrivateKeyError('The derived key is too large.')
+
+        exponent = (I_L + self._exponent) % SECP256k1.order
+        return PrivateKey(exponent, network=self.network)
+
+    def derive(self, index):
+        with stage('derivation'):
+            private_key = self.private_key(index)
+        with stage('wif_export'):
+            wif = private_key.export_to_wif(compressed=True)
+        with stage('address_encoding'):
+            address = private_key.get_public_key().to_address(compressed=True)
+        return Account(index, wif, address)
+
+    def derive_range(self, start, count):
+        for index in range(start, start + count):
+            yield self.derive(index)
+
+def iter_accounts(user_key, start, count, chain=EXTERNAL_CHAIN):
+    """Lazily yield Account(index, wif, address) for user_key/chain/start..start+count-1"""
+    return AccountDeriver(user_key, chain=chain).derive_range(start, count)
+
+MASTER_KEY_LENGTH = 64
+
+def master_key_material(wallet):
+    """Return the 64 bytes a master wallet is made of: its chain code followed by its private key"""
+    return unhexlify(wallet.chain_code) + unhexlify(wallet.get_private_key_hex())
+
+def wallet_from_key_material(key_material, network=BitcoinMainNet):
+    """Rebuild the master wallet from master_key_material()"""
+    if len(key_material) != MASTER_KEY_LENGTH:
+        raise ValueError('Master key material must be {} bytes'.format(MASTER_KEY_LENGTH))
+
+    return Wallet(depth=0,
+                  parent_fingerprint=0,
+                  child_number=0,
+                  chain_code=int(hexlify(key_material[:32]), 16),
+                  private_exponent=int(hexlify(key_material[32:]), 16),
+                  network=network)
@@ -0,0 +1,121 @@
+"""Encrypted shard strings.
+
+Shards are written as a compact binary envelope, base32 encoded once
+without padding:
+
+    version (1 byte) | flags (1 byte) | iterations (4 bytes) |
+    salt length (1 byte) | salt | nonce (12 bytes) | AES-256-GCM ciphertext |
+    checksum (2 bytes)
+
+The checksum is the start of the SHA256 of everything before it. Shards
+are typed in by hand, and it catches a mistyped character as soon as the
+shard is entered instead of after a key derivation.
+
+Base32 only uses upper case letters and digits, so the shard QR code is
+encoded in alphanumeric mode and the string can be typed in any case.
+The only flag records whether the passphrase carries a checksum.
+
+Shards written before the envelope existed are "<salt>$<token>" with a
+Fernet token, plain passphrases and 100000 iterations. The salt and token
+are both urlsafe base64.
+"""
+import base64
+import hashlib
+import os
+import struct
+
+from collections import namedtuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from .kdf import MAX_ITERATIONS
+
+COMPACT_VERSION = 3
+LEGACY_ITERATIONS = 100000
+
+FERNET = 'fernet'
+AES_GCM = 'aes-256-gcm'
+NONCE_LENGTH = 12
+CHECKSUM_FLAG = 0x01
+ENVELOPE_CHECKSUM_LENGTH = 2
+
+_COMPACT_HEADER = struct.Struct('>BBIB')
+
+Envelope = namedtuple('Envelope', ['iterations', 'salt', 'token', 'checksum', 'cipher'])
+
+def encrypt_token(plaintext, key):
+    """Return the nonce and AES-GCM ciphertext of plaintext for a compact envelope"""
+    nonce = os.urandom(NONCE_LENGTH)
+    return nonce + AESGCM(base64.urlsafe_b64decode(key)).encrypt(nonce, plaintext, None)
+
+def decrypt_token(envelope, key):
+    """Return the plaintext of envelope's token, raising InvalidToken if key is wrong"""
+    if envelope.cipher == FERNET:
+        return Fernet(key).decrypt(envelope.token)
+
+    nonce, ciphertext = envelope.token[:NONCE_LENGTH], envelope.token[NONCE_LENGTH:]
+    try:
+        return AESGCM(base64.urlsafe_b64decode(key)).decrypt(nonce, ciphertext, None)
+    except (InvalidTag, ValueError):
+        raise InvalidToken
+
+def _envelope_checksum(data):
+    return hashlib.sha256(data).digest()[:ENVELOPE_CHECKSUM_LENGTH]
+
+def encode_compact_envelope(salt, token, iterations, checksum=True):
+    header = _COMPACT_HEADER.pack(COMPACT_VERSION,
+                                  CHECKSUM_FLAG if checksum else 0,
+                                  iterations,
+                                  len(salt))
+    data = header + salt + token
+    return base64.b32encode(data + _envelope_checksum(data)).rstrip('=')
+
+def _parse_compact_envelope(encrypted_shard):
+    encoded = encrypted_shard.upper()
+    try:
+        data = base64.b32decode(encoded + '=' * (-len(encoded) % 8))
+    except TypeError:
+        raise ValueError('Unrecognized encrypted shard format')
+
+    if len(data) < _COMPACT_HEADER.size + ENVELOPE_CHECKSUM_LENGTH:
+        raise ValueError('Unrecognized encrypted shard format')
+    data, checksum = data[:-ENVELOPE_CHECKSUM_LENGTH], data[-ENVELOPE_CHECKSUM_LENGTH:]
+    if _envelope_checksum(data) != checksum:
+        raise ValueError('The encrypted shard does not match its checksum. A character has been mistyped')
+
+    version, flags, iterations, salt_length = _COMPACT_HEADER.unpack_from(data)
+    if version != COMPACT_VERSION:
+        raise ValueError('Unsupported encrypted shard version: {}'.format(version))
+    if iterations > MAX_ITERATIONS:
+        raise ValueError('Encrypted shard iterations are above the maximum of {}'.format(MAX_ITERATIONS))
+
+    body = data[_COMPACT_HEADER.size:]
+    if len(body) < salt_length + NONCE_LENGTH:
+        raise ValueError('Encrypted shard is truncated')
+    return Envelope(iterations,
+                    body[:salt_length],
+                    body[salt_length:],
+                    bool(flags & CHECKSUM_FLAG),
+                    AES_GCM)
+
+def parse_envelope(encrypted_shard):
+    """Return the Envelope of an encrypted shard string"""
+    encrypted_shard = encrypted_shard.strip()
+    if '$' not in encrypted_shard:
+        return _parse_compact_envelope(encrypted_shard)
+
+    parts = encrypted_shard.split('$')
+    if len(parts) != 2:
+        raise ValueError('Unrecognized encrypted shard format')
+
+    encoded_salt, encoded_token = parts
+    try:
+        return Envelope(LEGACY_ITERATIONS,
+                        base64.urlsafe_b64decode(encoded_salt),
+                        base64.urlsafe_b64decode(encoded_token),
+                        False,
+                        FERNET)
+    except TypeError:
+        raise ValueError('Unrecognized encrypted shard format')
@@ -1,27 +1,100 @@
 import os
-import tempfile
-import json
-import shutil
-import qrcode
+import re
+import threading
 import qrcode_terminal
-import base64
 
-from cryptography.fernet import Fernet, InvalidToken
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from collections import namedtuple
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+from cryptography.fernet import InvalidToken
 
 from secretsharing import BitcoinToB58SecretSharer
 
 from blessings import Terminal
 from bitmerchant.wallet import Wallet
 
-from .utils import _get_input, _print, word_generator
-
-PASSPHRASE_WORD_LENGTH = 8
-SALT_LENGTH = 32
+from .derivation import (MASTER_KEY_LENGTH,
+                         AccountDeriver,
+                         iter_accounts,
+                         master_key_material,
+                         wallet_from_key_material,
+                         )
+from .envelope import decrypt_token, encode_compact_envelope, encrypt_token, parse_envelope
+from .kdf import ITERATIONS, MAX_ITERATIONS, MIN_ITERATIONS, KDFExecutor, _ignore_sigint, derive_key
+from .passphrase import WORD_COUNT, new_passphrase, verify_checksum
+from .output import ARCHIVE_FORMATS, OUTPUT_BACKENDS
+from .profiling import profiler, stage
+from .typos import search_passphrase
+from .qr import (DEFAULT_QR_FORMATS,
+                 ERROR_CORRECTION_LEVELS,
+                 QR_FORMATS,
+                 QRRenderer,
+                 )
+from .shamir import MAX_SHARES, GF256SecretSharer, RecoveryContext, is_gf256_share
+from .sheet import SHEET_FORMATS, ContactSheet
+from .utils import _get_input, _print, dump_json
+from .wordindex import index as word_index
+
+SALT_LENGTH = 16
+USER_INFO_FILENAME = 'user_info.priv.json'
 term = Terminal()
-word_gen = word_generator()
+
+Bundle = namedtuple('Bundle', ['user_index',
+                               'output',
+                               'filename',
+                               'number_of_accounts',
+                               'first_address',
+                               'user_key',
+                               'options',
+                               ])
+
+class BundleOptions(object):
+    """Choices about how a user's bundle is written to disk"""
+    def __init__(self,
+                 lazy_qr=False,
+                 qr_error_correction='M',
+                 qr_formats=DEFAULT_QR_FORMATS,
+                 contact_sheet=None,
+                 output='directory',
+                 kdf_iterations=ITERATIONS):
+        if qr_error_correction not in ERROR_CORRECTION_LEVELS:
+            raise ValueError('QR error correction level must be one of {}'.format(', '.join(sorted(ERROR_CORRECTION_LEVELS))))
+
+        if not qr_formats or set(qr_formats) - set(QR_FORMATS):
+            raise ValueError('QR formats must be one or more of {}'.format(', '.join(sorted(QR_FORMATS))))
+
+        if contact_sheet is not None and contact_sheet not in SHEET_FORMATS:
+            raise ValueError('Contact sheet format must be one of {}'.format(', '.join(SHEET_FORMATS)))
+
+        if output not in OUTPUT_BACKENDS:
+            raise ValueError('Output must be one of {}'.format(', '.join(sorted(OUTPUT_BACKENDS))))
+
+        if lazy_qr and output in ARCHIVE_FORMATS:
+            raise ValueError('Lazy QR codes cannot be written to an archive that has already been closed')
+
+        if not MIN_ITERATIONS <= kdf_iterations <= MAX_ITERATIONS:
+            raise ValueError('KDF iterations must be between {} and {}'.format(MIN_ITERATIONS, MAX_ITERATIONS))
+
+        self.lazy_qr = lazy_qr
+        self.qr_error_correction = qr_error_correction
+        self.qr_formats = tuple(qr_formats)
+        self.contact_sheet = contact_sheet
+        self.output = output
+        self.kdf_iterations = kdf_iterations
+
+    def new_output(self):
+        return OUTPUT_BACKENDS[self.output]()
+
+    def __eq__(self, other):
+        return isinstance(other, BundleOptions) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'BundleOptions({})'.format(', '.join('{}={!r}'.format(key, value)
+                                                    for key, value in sorted(self.__dict__.items())))
 
 def _validate_generate_values(number_of_users,
                               number_of_accounts,
@@ -33,15 +106,56 @@ def _validate_generate_values(number_of_users,
     if number_of_accounts < 1:
         raise ValueError('Number of accounts must be greater than 1')
 
-    if key_threshold < 1 or key_threshold > number_of_users:
+    # A lone user holds the master key itself, any group shares it
+    minimum_threshold = 2 if number_of_users > 1 else 1
+    if key_threshold < minimum_threshold or key_threshold > number_of_users:
         raise ValueError('Key threshold must be greater than or equal to 2 and less than or equal to the number of users participating')
 
+def _master_fingerprint(wallet):
+    """Return the BIP32 fingerprint of the master wallet as 8 hex digits"""
+    return wallet.fingerprint[2:]
+
+def _format_piece(threshold, share, fingerprint=None):
+    """Return the plaintext of an encrypted shard.
+
+    Shards made before master fingerprints were recorded are just
+    "<threshold>-<share>".
+    """
+    if fingerprint is None:
+        return '{}-{}'.format(threshold, share)
+    return '{}-{}-{}'.format(threshold, fingerprint, share)
+
+_PIECE_PATTERN = re.compile(r'^(\d+)-(?:([0-9a-f]{8})-)?(.+)$', re.DOTALL)
+
+def _parse_piece(piece):
+    """Return the threshold, master fingerprint (or None) and share of a decrypted shard"""
+    match = _PIECE_PATTERN.match(piece)
+    if not match:
+        raise ValueError('The shard is not in a recognized format.')
+
+    threshold, fingerprint, share = match.groups()
+    return int(threshold), fingerprint, share
+
+def _user_data(user_index, number_of_users, key_threshold, shares, fingerprint=None):
+    if number_of_users > 1:
+        return {'child': '{index} of {total}'.format(index=user_index + 1,
+                                                     total=number_of_users),
+                'master_shard': _format_piece(key_threshold, shares[user_index], fingerprint),
+                }
+    return {}
+
 def generate(number_of_users=None,
              number_of_accounts=None,
              key_threshold=None,
-             extra_entropy=None):
+             extra_entropy=None,
+             parallel=False,
+             prefetch=False,
+             options=None):
     _print(term.clear)
 
+    if options is None:
+        options = BundleOptions()
+
     if number_of_users is None:
         number_of_users = _get_input('Enter number of users participating [1]: ', input_type=int, default=1)
 
@@ -61,158 +175,464 @@ def generate(number_of_users=None,
     _print('The system will now attempt to generate a master key and split it amongst the users\n'
            'This process may take awhile...')
 
-    master_wallet = Wallet.new_random_wallet(extra_entropy)
-    serialized_wallet = master_wallet.serialize_b58()
+    with stage('wallet_creation'):
+        master_wallet = Wallet.new_random_wallet(extra_entropy)
 
     if number_of_users > 1:
-        shares = BitcoinToB58SecretSharer.split_secret(serialized_wallet.encode(),
-                                                       key_threshold,
-                                                       number_of_users)
+        # Only the chain code and private key are shared. The rest of the
+        # serialized master key is the same for every master wallet.
+        with stage('secret_split'):
+            shares = GF256SecretSharer.split_secret(master_key_material(master_wallet),
+                                                    key_threshold,
+                                                    number_of_users)
     else:
         shares = None
 
-    for user_index in range(number_of_users):
-        _print(('The following screen is meant for user {index} (of {total})\n'
-                'Do not press continue if you are not user {index}').format(index=user_index + 1,
-                                                                            total=number_of_users),
-               formatters=[term.clear, term.red])
+    user_data = [_user_data(user_index, number_of_users, key_threshold, shares, _master_fingerprint(master_wallet))
+                 for user_index in range(number_of_users)]
+    if shares:
+        with KDFExecutor(processes=min(number_of_users, cpu_count())) as kdf_executor:
+            _encrypt_shards(user_data, kdf_executor, options.kdf_iterations)
 
-        _get_input('Press enter to continue when ready')
-        _print(term.clear)
-
-        if number_of_users > 1:
-            data = {'child': '{index} of {total}'.format(index=user_index + 1,
-                                                         total=number_of_users),
-                    'master_shard': '{}-{}'.format(key_threshold, shares[user_index]),
-                    }
-        else:
-            data = {}
-        _generateKeys(master_wallet, user_index, number_of_accounts, extra_data=data)
+    if parallel:
+        bundle_pool = BundlePool(master_wallet, number_of_accounts, user_data, options)
+    elif prefetch:
+        bundle_pool = BundlePrefetcher(master_wallet, number_of_accounts, user_data, options)
+    else:
+        bundle_pool = None
+
+    try:
+        for user_index in range(number_of_users):
+            _print(('The following screen is meant for user {index} (of {total})\n'
+                    'Do not press continue if you are not user {index}').format(index=user_index + 1,
+                                                                                total=number_of_users),
+                   formatters=[term.clear, term.red])
+
+            _get_input('Press enter to continue when ready')
+            _print(term.clear)
+
+            if bundle_pool:
+                _present_bundle(bundle_pool.next())
+            else:
+                _generateKeys(master_wallet,
+                              user_index,
+                              number_of_accounts,
+                              extra_data=user_data[user_index],
+                              options=options)
+    finally:
+        if bundle_pool:
+            bundle_pool.close()
 
     _print('All done')
 
-def recover():
-    shards = []
-
-    user_index = _get_input("Enter the index of the user who's key should be regenerated: ", input_type=int) - 1
+def _validate_users(users):
+    if not users or min(users) < 1 or max(users) > MAX_SHARES:
+        raise ValueError('User indexes must be greater than or equal to 1 and less than or equal to {}'.format(MAX_SHARES))
+
+def parse_users(text):
+    """Return the distinct user indexes in a comma separated list, in the order given"""
+    try:
+        users = [int(user) for user in text.replace(',', ' ').split()]
+    except ValueError:
+        raise ValueError('User indexes must be whole numbers separated by commas')
+    _validate_users(users)
+
+    distinct = []
+    for user in users:
+        if user not in distinct:
+            distinct.append(user)
+    return distinct
+
+def _describe_users(users):
+    if len(users) == 1:
+        return 'user {}'.format(users[0])
+    return 'users {}'.format(', '.join(str(user) for user in users))
+
+def recover(users=None):
+    """Regenerate the keys of every user in users (1 based indexes) from one set of master shards.
+
+    The users are asked for if they are not given. The shards are entered
+    and decrypted once however many users are recovered.
+    """
+    if users is None:
+        users = parse_users(_get_input('Enter the indexes of the users whose keys should be regenerated, separated by commas: '))
+    else:
+        _validate_users(users)
     number_of_accounts = _get_input('Enter number of accounts to be created per user [1]: ',
                                     input_type=int,
                                     default=1)
     _print(term.clear)
 
+    # Each shard is decrypted in the background while the next user types
+    # theirs in. The previous user's shard is only resolved once the next
+    # one has been entered, and the first one to resolve gives the
+    # threshold. Shards are only ever split with a threshold of at least 2,
+    # and ShardSet turns away any that claim less, so a second user is
+    # always needed. Shards set aside while they are accepted are made up
+    # for by asking the next user.
+    shard_set = ShardSet()
     key_progress = 0
-    finished = False
+    pending = None
+
+    with KDFExecutor(processes=2) as kdf_executor:
+        while True:
+            if shard_set.threshold is not None and len(shard_set.shards) + (pending is not None) >= shard_set.threshold:
+                if pending is None:
+                    break
+                _accept_shard(pending, shard_set, kdf_executor)
+                pending = None
+                continue
+
+            _print(term.clear)
+            if key_progress == 0:
+                _print('Starting on the next screen, each user will be asked to input their piece of the master key.')
+            else:
+                _print('The next screen is for the next user.')
+            _get_input('Press enter to continue')
+
+            _print(term.clear)
+            _print('Attempting to recover keys for {}'.format(_describe_users(users)))
+            _print('Key progress: {}'.format(key_progress))
+            _print()
 
-    while not finished:
-        _print(term.clear)
-        if key_progress == 0:
-            _print('Starting on the next screen, each user will be asked to input their piece of the master key.')
-        else:
-            _print('The next screen is for the next user.')
+            decryption = _read_shard(kdf_executor=kdf_executor)
+            key_progress += 1
+
+            _print()
+            _print('Shard has been received and is being checked in the background', formatters=term.blue)
+            _get_input('Press enter to continue')
+
+            if pending is not None:
+                _accept_shard(pending, shard_set, kdf_executor)
+            pending = (key_progress, decryption)
+
+    recovery = _recovery_context(shard_set.shards)
+    with stage('secret_recover'):
+        master_key = recovery.secret()
+    with stage('wallet_deserialize'):
+        master_wallet = _deserialize_master(master_key)
+    shard_set.verify(master_wallet)
+
+    user_data = []
+    for user in users:
+        with stage('share_recover'):
+            user_share = recovery.share(user)
+        user_data.append({'child': 'user {}'.format(user),
+                          'master_shard': _format_piece(shard_set.threshold, user_share, shard_set.fingerprint),
+                          })
+
+    # Every replacement shard is encrypted at once, at the cost the group
+    # was given, as generate() does
+    options = BundleOptions(kdf_iterations=shard_set.kdf_iterations)
+    with KDFExecutor(processes=min(len(users), cpu_count())) as kdf_executor:
+        _encrypt_shards(user_data, kdf_executor, options.kdf_iterations)
+
+    for user, data in zip(users, user_data):
+        _print('The next screen is meant for user {}'.format(user), formatters=term.clear)
         _get_input('Press enter to continue')
 
-        _print(term.clear)
-        _print('Attempting to recover keys for user {}'.format(user_index + 1))
-        _print('Key progress: {}'.format(key_progress))
-        _print()
+        _generateKeys(master_wallet, user - 1, number_of_accounts, extra_data=data, options=options)
 
-        piece = decrypt_shard()
+def _deserialize_master(master_key):
+    """Return the master wallet for a recovered secret.
 
-        threshold, shard = piece.split('-', 1)
-        shards.append(shard)
-        threshold = int(threshold)
+    Shards made before only the key material was shared hold the base58
+    serialized master key instead.
+    """
+    if len(master_key) == MASTER_KEY_LENGTH:
+        return wallet_from_key_material(master_key)
+    return Wallet.deserialize(master_key)
 
-        if key_progress == 0:
-            initial_threshold = threshold
-        else:
-            if initial_threshold != threshold:
-                raise ValueError('Shard thresholds do not match. An invalid shard has been provided.')
+class LegacyRecoveryContext(object):
+    """RecoveryContext for shards split by BitcoinToB58SecretSharer"""
+    def __init__(self, shards):
+        self.shards = shards
 
-        _print()
-        _print('Shard has been accepted', formatters=term.blue)
-        _get_input('Press enter to continue')
+    def secret(self):
+        return BitcoinToB58SecretSharer.recover_secret(self.shards)
 
-        key_progress += 1
+    def share(self, x):
+        return BitcoinToB58SecretSharer.recover_share(self.shards, x)
 
-        if key_progress == threshold:
-            finished = True
+def _recovery_context(shards):
+    """Return a recovery context for the secret sharer the shards were made with.
 
-    _print('The next screen is meant for user {}'.format(user_index + 1), formatters=term.clear)
-    _get_input('Press enter to continue')
+    Shards made before the GF(256) sharer were split by
+    BitcoinToB58SecretSharer and are still recovered with it.
+    """
+    gf256_shards = [is_gf256_share(shard) for shard in shards]
+    if all(gf256_shards):
+        return RecoveryContext(shards)
+    if not any(gf256_shards):
+        return LegacyRecoveryContext(shards)
+    raise ValueError('Shards from different key generations have been provided.')
 
-    master_key = BitcoinToB58SecretSharer.recover_secret(shards)
-    master_wallet = Wallet.deserialize(master_key)
+def _resolve_shard(participant, decryption):
+    while True:
+        try:
+            return decryption.result()
+        except InvalidToken:
+            _print(term.clear)
+            _print('Failed to decrypt the shard entered by participant {}.'.format(participant), formatters=term.red)
+            _print('The next screen is for participant {}'.format(participant))
+            _get_input('Press enter to continue')
 
-    user_share = BitcoinToB58SecretSharer.recover_share(shards, user_index + 1)
+            _print(term.clear)
+            decrypted_shard = _offer_retry(decryption)
+            if decrypted_shard is not None:
+                return decrypted_shard
 
-    data = {'child': 'user {}'.format(user_index + 1),
-            'master_shard': '{}-{}'.format(threshold, user_share),
-            }
+            _print('Participant {}, enter your passphrase again'.format(participant))
+            _print()
+            decryption.retry()
+
+class ShardMismatchError(ValueError):
+    """A shard disagrees with the threshold or master fingerprint of the shards entered before it"""
+
+class ShardSet(object):
+    """The decrypted shards entered so far.
+
+    The first shard gives the threshold and master fingerprint. Every
+    later shard is checked against them as soon as it is decrypted, so a
+    shard from another key generation is turned away before the rest of
+    the shards are entered. If it is the earlier shards that are wrong,
+    replace() sets them aside and starts again from the later one.
+    """
+    def __init__(self):
+        self.shards = []
+        self.iterations = []
+        self.threshold = None
+        self.fingerprint = None
+
+    @property
+    def kdf_iterations(self):
+        """The highest KDF iteration count the entered shards were encrypted with"""
+        return max(self.iterations)
+
+    def add(self, piece, iterations=ITERATIONS):
+        threshold, fingerprint, shard = _parse_piece(piece)
+        if threshold < 2:
+            raise ValueError('Shard thresholds must be at least 2. An invalid shard has been provided.')
+        if self.shards:
+            if threshold != self.threshold:
+                raise ShardMismatchError('Shard thresholds do not match. An invalid shard has been provided.')
+            if fingerprint != self.fingerprint:
+                raise ShardMismatchError('The shard belongs to a different master key than the shards entered before it.')
+            if shard in self.shards:
+                raise ValueError('This shard has already been entered.')
+        else:
+            self.threshold = threshold
+            self.fingerprint = fingerprint
+
+        self.shards.append(shard)
+        self.iterations.append(iterations)
+
+    def replace(self, piece, iterations=ITERATIONS):
+        """Set aside every shard entered so far and start again from piece"""
+        self.shards = []
+        self.iterations = []
+        self.threshold = None
+        self.fingerprint = None
+        self.add(piece, iterations)
+
+    def verify(self, master_wallet):
+        """Check the recovered master wallet against the shards' master fingerprint"""
+        if self.fingerprint is not None and _master_fingerprint(master_wallet) != self.fingerprint:
+            raise ValueError('The recovered master key does not match its fingerprint. An invalid shard has been provided.')
+
+def _accept_shard(pending, shard_set, kdf_executor):
+    """Add the pending shard to shard_set, asking its participant for another shard until one fits.
+
+    A rejected shard can instead be set aside, or, if it disagrees with
+    the shards entered before it, kept in place of them.
+    """
+    participant, decryption = pending
+    while True:
+        piece = _resolve_shard(participant, decryption)
+        try:
+            shard_set.add(piece, decryption.iterations)
+            return
+        except ValueError as e:
+            _print(term.clear)
+            _print('The shard entered by participant {} was rejected. {}'.format(participant, e), formatters=term.red)
+            mismatch = isinstance(e, ShardMismatchError)
+            if mismatch:
+                _print('Either this shard or the shards entered before it came from another key generation.')
+                prompt = ('Press enter to have participant {} enter their shard again, type "skip" to set it aside\n'
+                          'or type "replace" to keep it and set aside the shards entered before it').format(participant)
+            else:
+                prompt = 'Press enter to have participant {} enter their shard again or type "skip" to set it aside'.format(participant)
+
+            answer = _get_input(prompt).strip().lower()
+            if answer == 'skip':
+                _print('The shard entered by participant {} has been set aside. Another user will be asked for theirs.'.format(participant))
+                _get_input('Press enter to continue')
+                return
+            if mismatch and answer == 'replace':
+                shard_set.replace(piece, decryption.iterations)
+                _print('The shards entered before participant {} have been set aside. Other users will be asked for theirs.'.format(participant))
+                _get_input('Press enter to continue')
+                return
+
+            _print('The next screen is for participant {}'.format(participant))
+            _get_input('Press enter to continue')
+
+            _print(term.clear)
+            _print('Participant {}, enter your shard again'.format(participant))
+            _print()
+            decryption = _read_shard(kdf_executor=kdf_executor)
+
+def _encrypt_shard(shard, salt, key, iterations):
+    with stage('cipher'):
+        token = encrypt_token(shard, key)
+    return encode_compact_envelope(salt, token, iterations)
 
-    _generateKeys(master_wallet, user_index, number_of_accounts, extra_data=data)
+def _encrypt_shards(user_data, kdf_executor, iterations=ITERATIONS):
+    """Encrypt every user's master shard, deriving all of the keys at once on the executor"""
+    jobs = [(new_passphrase(), os.urandom(SALT_LENGTH), iterations) for data in user_data]
+    with stage('pbkdf2'):
+        keys = kdf_executor.map(jobs)
 
-def _generateKeys(master_wallet, user_index, number_of_accounts, extra_data=None):
-    directory = tempfile.mkdtemp()
-    user_key = master_wallet.get_child(user_index, is_prime=True) # m/user_index'
+    for data, (passphrase, salt, iterations), key in zip(user_data, jobs, keys):
+        data['encrypted_shard'] = _encrypt_shard(data.pop('master_shard'), salt, key, iterations)
+        data['passphrase'] = passphrase
+
+class AccountQRFiles(object):
+    """Write a private key and an address QR code file per account"""
+    def __init__(self, output, renderer, formats=DEFAULT_QR_FORMATS):
+        self.output = output
+        self.renderer = renderer
+        self.formats = formats
+
+    def write(self, account):
+        self.renderer.save('wif',
+                           account.wif,
+                           self.output,
+                           'child{}.priv'.format(account.index + 1),
+                           self.formats)
+        self.renderer.save('address',
+                           account.address,
+                           self.output,
+                           'child{}.pub'.format(account.index + 1),
+                           self.formats)
+
+    def close(self):
+        pass
+
+def _account_qr_writer(output, options):
+    renderer = QRRenderer(options.qr_error_correction)
+    if options.contact_sheet:
+        return ContactSheet(output, renderer, options.contact_sheet)
+    return AccountQRFiles(output, renderer, options.qr_formats)
+
+def _account_entries(user_key, number_of_accounts, qr_writer=None):
+    for account in iter_accounts(user_key, 0, number_of_accounts): # m/user_index'/0/idx BIP32 compliant external accounts
+        if qr_writer:
+            qr_writer.write(account)
+
+        yield {'wif': account.wif,
+               'address': account.address,
+               }
+
+class BackgroundQRWriter(object):
+    """Write the account QR codes of a bundle on a background thread pool.
+
+    Accounts are re-derived from the user key as they are rendered. Once
+    cancel() is called the remaining accounts are skipped.
+    """
+    def __init__(self, user_key, number_of_accounts, qr_writer, threads=None):
+        self.total = number_of_accounts
+        self.written = 0
+        self._qr_writer = qr_writer
+        self._deriver = AccountDeriver(Wallet.deserialize(user_key))
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+        self._pool = ThreadPool(threads or cpu_count())
+        self._result = self._pool.map_async(self._write, range(number_of_accounts))
+        self._pool.close()
+
+    def _write(self, index):
+        if self._cancelled.is_set():
+            return
+
+        self._qr_writer.write(self._deriver.derive(index))
+        with self._lock:
+            self.written += 1
+
+    def done(self):
+        return self._result.ready()
+
+    def wait(self):
+        self._result.wait()
+        self._pool.join()
+        self._qr_writer.close()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._pool.join()
+        self._qr_writer.close()
+
+def _build_bundle(master_wallet, user_index, number_of_accounts, extra_data=None, output=None, options=None):
+    if options is None:
+        options = BundleOptions()
+    if output is None:
+        output = options.new_output()
+    qr_writer = _account_qr_writer(output, options)
+    with stage('derivation'):
+        user_key = master_wallet.get_child(user_index, is_prime=True) # m/user_index'
 
     data = {'user_key': user_key.serialize_b58(),
-            'accounts': [],
+            'master_fingerprint': _master_fingerprint(master_wallet),
             }
     if extra_data:
         data.update(extra_data)
 
-    first = None
-    for idx in range(number_of_accounts):
-        account_entry = {}
-        child = user_key.get_child(0).get_child(idx) # m/user_index'/0/idx BIP32 compliant external accounts
-
-        if idx == 0:
-            first = child
-
-        account_entry['wif'] = child.export_to_wif()
-        account_entry['address'] = child.to_address()
-
-        img = qrcode.make(account_entry['wif'])
-        qr_filename = os.path.join(directory, 'child{}.priv.png'.format(idx + 1))
-        img.save(qr_filename)
-
-        img = qrcode.make(account_entry['address'])
-        qr_filename = os.path.join(directory, 'child{}.pub.png'.format(idx + 1))
-        img.save(qr_filename)
-
-        data['accounts'].append(account_entry)
-
-    if 'master_shard' in data:
-        salt = os.urandom(SALT_LENGTH)
-        shard = data.pop('master_shard')
-        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
-                         length=32,
-                         salt=salt,
-                         iterations=100000,
-                         backend=default_backend())
-        words = [word_gen.next() for x in range(PASSPHRASE_WORD_LENGTH)]
-        passphrase = ' '.join(words)
-        key = base64.urlsafe_b64encode(kdf.derive(passphrase))
-        f = Fernet(key)
-        token = f.encrypt(shard)
-
-        data['encrypted_shard'] = '{}${}'.format(base64.urlsafe_b64encode(salt),
-                                                 base64.urlsafe_b64encode(token))
-        data['passphrase'] = passphrase
-        shard_img = qrcode.make(data['encrypted_shard'])
-        shard_img_filename = os.path.join(directory, 'child{}_shard.png'.format(user_index + 1))
-        shard_img.save(shard_img_filename)
-
-    filename = os.path.join(directory, 'user_info.priv.json'.format(user_index + 1))
-    json_data = json.dumps(data)
-    with open(filename, 'w+b') as f:
-        f.write(json_data)
+    if 'encrypted_shard' in data:
+        qr_writer.renderer.save('shard',
+                                data['encrypted_shard'],
+                                output,
+                                'child{}_shard'.format(user_index + 1),
+                                options.qr_formats)
+
+    # Accounts are streamed straight into the file so memory use does not
+    # grow with number_of_accounts. The account stages therefore run nested
+    # inside json_write.
+    data['accounts'] = _account_entries(user_key,
+                                        number_of_accounts,
+                                        qr_writer=None if options.lazy_qr else qr_writer)
+    filename = USER_INFO_FILENAME
+    with stage('json_write'), output.open(filename) as f:
+        dump_json(data, f)
+    if not options.lazy_qr:
+        qr_writer.close()
+    output.finish()
+
+    first = next(iter_accounts(user_key, 0, 1), None)
+
+    return Bundle(user_index,
+                  output,
+                  filename,
+                  number_of_accounts,
+                  first.address if first else None,
+                  data['user_key'],
+                  options)
+
+def _present_bundle(bundle):
+    if bundle.options.lazy_qr:
+        qr_writer = BackgroundQRWriter(bundle.user_key,
+                                       bundle.number_of_accounts,
+                                       _account_qr_writer(bundle.output, bundle.options))
+        qr_message = 'QR codes are being written in the background for {number_of_accounts} account(s)'
+    else:
+        qr_writer = None
+        qr_message = 'QR codes have been written for {number_of_accounts} account(s)'
 
     _print(('Key for user {user_index}:\n'
-            'Data has been written to {filename}\n'
-            'QR codes have been written for {number_of_accounts} account(s)').format(number_of_accounts=number_of_accounts,
-                                                                                     filename=filename,
-                                                                                     user_index=user_index + 1),
+            'Data has been written to {filename}\n' +
+            qr_message).format(number_of_accounts=bundle.number_of_accounts,
+                               filename=bundle.output.describe(bundle.filename),
+                               user_index=bundle.user_index + 1),
             formatters=[term.clear, term.blue])
     _print()
     _print('Take the time to copy these files before continuing\n'
@@ -224,48 +644,284 @@ def _generateKeys(master_wallet, user_index, number_of_accounts, extra_data=None
            formatters=[term.red, term.bold])
     _print()
 
-    if first:
+    if bundle.first_address:
         _print('Your first account address is being displayed here for your convenience')
         _print()
-        address = first.to_address()
+        address = bundle.first_address
         _print(address)
         _print()
         qrcode_terminal.draw(address)
         _print()
     _get_input('Press enter to continue when ready')
 
-    shutil.rmtree(directory)
-    _print(term.clear)
+    if qr_writer:
+        while not qr_writer.done():
+            answer = _get_input(('QR codes have been written for {} of {} account(s).\n'
+                                 'Press enter to check again or type "skip" to continue without the rest').format(qr_writer.written,
+                                                                                                                   qr_writer.total))
+            if answer.strip().lower() == 'skip':
+                break
+        qr_writer.cancel()
 
-def decrypt_shard():
-    encoded_salt, encrypted_shard = _get_input('Enter encrypted shard: ').strip().split('$')
-    salt = base64.urlsafe_b64decode(encoded_salt)
+    if bundle.output.needs_export:
+        _export_bundle(bundle)
 
+    bundle.output.destroy()
+    _print(term.clear)
+
+def _export_bundle(bundle):
+    _print('These files are held in memory and have not been written to disk:')
+    for name in bundle.output.names():
+        _print('    {}'.format(name))
     _print()
-    done = False
-    while not done:
-        words = []
-        for i in range(1, PASSPHRASE_WORD_LENGTH + 1):
-            word = _get_input('Enter word #{}: '.format(i), secure=True).strip()
 
-            if not word:
+    while True:
+        destination = _get_input('Enter a directory to export them to or press enter to continue: ').strip()
+        if not destination:
+            break
+
+        try:
+            paths = bundle.output.export(destination)
+        except (IOError, OSError) as e:
+            _print('Unable to export to {}: {}'.format(destination, e), formatters=[term.red])
+        else:
+            _print('Exported {} file(s) to {}'.format(len(paths), destination))
+        _print()
+
+def _generateKeys(master_wallet, user_index, number_of_accounts, extra_data=None, options=None):
+    _present_bundle(_build_bundle(master_wallet,
+                                  user_index,
+                                  number_of_accounts,
+                                  extra_data=extra_data,
+                                  options=options))
+
+def _build_bundle_job(job):
+    serialized_wallet, user_index, number_of_accounts, extra_data, output, options, profile = job
+    if profile:
+        profiler.enable()
+    bundle = _build_bundle(Wallet.deserialize(serialized_wallet),
+                           user_index,
+                           number_of_accounts,
+                           extra_data=extra_data,
+                           output=output,
+                           options=options)
+    return bundle, profiler.drain()
+
+def _collect_bundle(result):
+    bundle, stages = result
+    profiler.merge(stages)
+    return bundle
+
+class BundlePool(object):
+    """Build every user's bundle up front on a process pool.
+
+    Bundles are handed back in user order by next(). The outputs are created
+    here so that close() can remove anything that was never presented, e.g.
+    after the ceremony is aborted.
+    """
+    def __init__(self, master_wallet, number_of_accounts, user_data, options, processes=None):
+        serialized_wallet = master_wallet.serialize_b58()
+        self.outputs = [options.new_output() for data in user_data]
+        self._jobs = [(serialized_wallet, user_index, number_of_accounts, data, output, options, profiler.enabled)
+                      for user_index, (data, output) in enumerate(zip(user_data, self.outputs))]
+
+        self._pool = Pool(processes=processes or min(len(self._jobs), cpu_count()),
+                          initializer=_ignore_sigint)
+        self._start()
+
+    def _start(self):
+        self._results = self._pool.imap(_build_bundle_job, self._jobs)
+        self._pool.close()
+
+    def next(self):
+        return _collect_bundle(next(self._results))
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        for output in self.outputs:
+            output.destroy()
+
+class BundlePrefetcher(BundlePool):
+    """Build one bundle ahead in a background process.
+
+    The next user's bundle is started as soon as the current one is handed
+    out, so it is built while the current user is copying their files.
+    """
+    def __init__(self, master_wallet, number_of_accounts, user_data, options):
+        super(BundlePrefetcher, self).__init__(master_wallet, number_of_accounts, user_data, options, processes=1)
+
+    def _start(self):
+        self._jobs = iter(self._jobs)
+        self._pending = self._submit()
+
+    def _submit(self):
+        job = next(self._jobs, None)
+        if job is None:
+            return None
+        return self._pool.apply_async(_build_bundle_job, (job,))
+
+    def next(self):
+        if self._pending is None:
+            raise StopIteration
+        result = self._pending.get()
+        self._pending = self._submit()
+        return _collect_bundle(result)
+
+def _get_word(i):
+    """Prompt for word #i until it is in the word list or a unique prefix of a word in it"""
+    while True:
+        word = _get_input('Enter word #{}: '.format(i), secure=True).strip().lower()
+        if not word:
+            return word
+
+        resolved = word_index.resolve(word)
+        if resolved:
+            return resolved
+
+        # The typed word is not echoed back since it is part of the passphrase
+        if word_index.completions(word):
+            _print('Word #{} matches more than one word. Type more of it.'.format(i), formatters=term.red)
+        else:
+            _print('Word #{} is not in the word list. Try again.'.format(i), formatters=term.red)
+
+def _get_passphrase():
+    words = []
+    for i in range(1, WORD_COUNT + 1):
+        word = _get_word(i)
+
+        if not word:
+            break
+
+        words.append(word)
+    return ' '.join(words)
+
+class ShardDecryption(object):
+    """An encrypted shard whose key is derived in the background.
+
+    With a KDF executor the derivation starts as soon as the passphrase
+    has been entered and result() only waits for whatever is left of it.
+    result() raises InvalidToken if the passphrase was wrong; retry() asks
+    for the passphrase again. A checksummed passphrase that fails its
+    checksum is asked for again as soon as it is typed, while the
+    participant is still at the screen. If they keep it anyway, result()
+    rejects it straight away, without a derivation.
+    """
+    def __init__(self, envelope, kdf_executor=None):
+        self.envelope = envelope
+        self.iterations = envelope.iterations
+        self.salt = envelope.salt
+        self.checksum = envelope.checksum
+        self._kdf_executor = kdf_executor
+        self.retry()
+
+    def reenter(self):
+        """Ask for the encrypted shard again. retry() then asks for its passphrase."""
+        self.envelope = _read_envelope()
+        self.iterations = self.envelope.iterations
+        self.salt = self.envelope.salt
+        self.checksum = self.envelope.checksum
+
+    def retry(self):
+        while True:
+            self._passphrase = _get_passphrase()
+            self._mistyped = self.checksum and not verify_checksum(self._passphrase)
+            if not self._mistyped:
                 break
 
-            words.append(word)
+            _print('The passphrase does not match its checksum, so one of its words is wrong.', formatters=term.red)
+            answer = _get_input('Press enter to type it again or type "keep" to keep it and search for the wrong word later: ')
+            if answer.strip().lower() == 'keep':
+                break
+
+        if self._mistyped:
+            self._key = None
+        elif self._kdf_executor:
+            self._key = self._kdf_executor.submit(self._passphrase, self.salt, self.iterations)
+        else:
+            self._key = None
+
+    def passphrase_verified(self):
+        """Return True if the passphrase carries a checksum and matches it"""
+        return bool(self.checksum) and not self._mistyped
+
+    def search(self, kdf_executor):
+        """Look for a passphrase close to the one typed that decrypts the shard.
+
+        Returns the decrypted shard, or None if no candidate worked.
+        """
+        with stage('typo_search'):
+            found = search_passphrase(self._passphrase.split(),
+                                      self.envelope,
+                                      kdf_executor,
+                                      candidate_filter=verify_checksum if self.checksum else None)
+        if found is None:
+            return None
+
+        self._passphrase, decrypted_shard = found
+        return decrypted_shard
+
+    def result(self):
+        if self._mistyped:
+            raise InvalidToken
+
+        with stage('pbkdf2'):
+            if self._key:
+                key = self._key.get()
+            else:
+                key = derive_key(self._passphrase, self.salt, self.iterations)
+        with stage('cipher'):
+            return decrypt_token(self.envelope, key)
+
+def _read_envelope():
+    """Prompt for an encrypted shard until it can be read"""
+    while True:
+        try:
+            envelope = parse_envelope(_get_input('Enter encrypted shard: '))
+        except ValueError as e:
+            _print('{}. Enter the encrypted shard again.'.format(e), formatters=term.red)
+        else:
+            _print()
+            return envelope
+
+def _read_shard(kdf_executor=None):
+    return ShardDecryption(_read_envelope(), kdf_executor=kdf_executor)
+
+def _offer_retry(decryption):
+    """Ask whether to search for the passphrase, enter the shard again or type the passphrase again.
+
+    Returns the decrypted shard if a search found it, otherwise None. The
+    caller then has decryption ask for the passphrase again.
+    """
+    if decryption.passphrase_verified():
+        _print('The passphrase matches its checksum, so the encrypted shard may have been entered wrong.')
+    answer = _get_input('Type "search" to look for a passphrase close to the one entered, "shard" to enter the encrypted shard again\n'
+                        'or press enter to type the passphrase again: ').strip().lower()
+    if answer == 'shard':
+        decryption.reenter()
+        return None
+    if answer != 'search':
+        return None
+
+    _print('Searching for the passphrase. This may take a while...')
+    with KDFExecutor() as kdf_executor:
+        decrypted_shard = decryption.search(kdf_executor)
+
+    if decrypted_shard is None:
+        _print('No close passphrase was found', formatters=term.red)
+        _print()
+    return decrypted_shard
 
-        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
-                         length=32,
-                         salt=salt,
-                         iterations=100000,
-                         backend=default_backend())
-        passphrase = ' '.join(words)
-        key = base64.urlsafe_b64encode(kdf.derive(passphrase))
-        f = Fernet(key)
+def decrypt_shard(kdf_executor=None):
+    decryption = _read_shard(kdf_executor=kdf_executor)
+    while True:
         try:
-            decrypted_shard = f.decrypt(base64.urlsafe_b64decode(encrypted_shard))
+            return decryption.result()
         except InvalidToken:
             _print('Failed to decrypt shard. Try Again.', formatters=term.red)
             _print()
-            continue
-        done = True
-    return decrypted_shard
+
+            decrypted_shard = _offer_retry(decryption)
+            if decrypted_shard is not None:
+                return decrypted_shard
+            decryption.retry()
@@ -0,0 +1,77 @@
+import base64
+import signal
+import time
+
+from multiprocessing import Pool, cpu_count
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+ITERATIONS = 100000
+MIN_ITERATIONS = 100000
+# Tens of seconds of PBKDF2 on current hardware. A larger count in a shard
+# is a typo, not a setting, and would tie up the KDF for hours.
+MAX_ITERATIONS = 10000000
+KEY_LENGTH = 32
+
+def derive_key(passphrase, salt, iterations=ITERATIONS):
+    """Return the urlsafe base64 shard key for a passphrase"""
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
+                     length=KEY_LENGTH,
+                     salt=salt,
+                     iterations=iterations,
+                     backend=default_backend())
+    return base64.urlsafe_b64encode(kdf.derive(passphrase))
+
+def calibrate(target_seconds, sample_iterations=20000):
+    """Return the iteration count that takes about target_seconds on this machine.
+
+    The result is rounded to a thousand and kept between MIN_ITERATIONS and
+    MAX_ITERATIONS.
+    """
+    start = time.time()
+    derive_key(b'calibration', b'\0' * 32, iterations=sample_iterations)
+    elapsed = max(time.time() - start, 1e-6)
+
+    iterations = int(sample_iterations * target_seconds / elapsed) // 1000 * 1000
+    return min(max(iterations, MIN_ITERATIONS), MAX_ITERATIONS)
+
+def _derive_key_job(job):
+    return derive_key(*job)
+
+def _ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class KDFExecutor(object):
+    """Run shard key derivations on a process pool.
+
+    PBKDF2 is pure CPU work, so deriving the keys for several shards at
+    once takes about as long as deriving one, up to the number of cores.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes or cpu_count()
+        self._pool = Pool(processes=self.processes,
+                          initializer=_ignore_sigint)
+
+    def submit(self, passphrase, salt, iterations=ITERATIONS):
+        """Start a derivation and return its AsyncResult"""
+        return self._pool.apply_async(_derive_key_job, ((passphrase, salt, iterations),))
+
+    def derive(self, passphrase, salt, iterations=ITERATIONS):
+        return self.submit(passphrase, salt, iterations).get()
+
+    def map(self, jobs):
+        """Derive keys for a list of (passphrase, salt) or (passphrase, salt, iterations) tuples"""
+        return self._pool.map(_derive_key_job, jobs)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
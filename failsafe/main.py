@@ -1,47 +1,86 @@
 """Bitcoin Failsafe
 
 Usage:
-    failsafe [-u USERS] [-a ACCOUNTS] [-t THRESHOLD] [-e ENTROPY]
-    failsafe (-r | --recover)
+    failsafe [-u USERS] [-a ACCOUNTS] [-t THRESHOLD] [-e ENTROPY] [--parallel | --prefetch] [--profile] [options]
+    failsafe (-r | --recover) [--recover-users=<indexes>] [--profile]
     failsafe (-h | --help)
     failsafe --version
 
 Options:
-    -u --users      Number of users participating
-    -a --accounts   Number of accounts to be created per user
-    -t --threshold  Number of master shards required to regenerate a user's key
-    -r --recover    Recover a user account from master shards
-    -h --help       Show this screen.
-    --version       Show version
+    -u --users                     Number of users participating
+    -a --accounts                  Number of accounts to be created per user
+    -t --threshold                 Number of master shards required to regenerate a user's key
+    --parallel                     Build every user's files up front on a process pool
+    --prefetch                     Build the next user's files in the background while the current user copies theirs
+    --lazy-qr                      Write account QR codes in the background while the user's screen is shown
+    --qr-error-correction=<level>  QR code error correction level: L, M, Q or H [default: M]
+    --qr-format=<formats>          Comma separated QR code file formats: png, svg, pbm or matrix [default: png]
+    --contact-sheet=<format>       Tile the account QR codes onto labelled pages instead of separate files: pdf or png
+    --output=<backend>             Write each user's files to a temporary directory, to memory until exported or to a single tar or zip
+                                   archive with a SHA256SUMS manifest: directory, memory, tar or zip [default: directory]
+    --kdf-iterations=<n>           PBKDF2 iterations used to encrypt each user's shard [default: 100000]
+    --kdf-target=<seconds>         Pick the PBKDF2 iterations that take this long on this machine instead
+    -r --recover                   Recover user accounts from master shards
+    --recover-users=<indexes>      Comma separated indexes of the users to recover from one set of shards instead of being asked
+    --profile                      Write a JSON report of the time spent in each stage to stderr
+    -h --help                      Show this screen.
+    --version                      Show version
 """
 from __future__ import print_function
 
+import json
+import sys
+
 from docopt import docopt
 
 from ._version import get_versions
 
 from blessings import Terminal
-from .failsafe import generate, recover
+from .failsafe import BundleOptions, generate, parse_users, recover
+from .kdf import calibrate
+from .profiling import profiler, stage
 
 VERSION = get_versions()['version']
 
 term = Terminal()
 
 def main():
+    arguments = docopt(__doc__, version=get_versions()['version'])
+    if arguments['--profile']:
+        profiler.enable()
+
     try:
-        arguments = docopt(__doc__, version=get_versions()['version'])
         if arguments['--version']:
             print(VERSION)
         if not arguments['--recover']:
-            generate(number_of_accounts=int(arguments['ACCOUNTS']) if arguments['ACCOUNTS'] else None,
-                     key_threshold=int(arguments['THRESHOLD']) if arguments['THRESHOLD'] else None,
-                     number_of_users=int(arguments['USERS']) if arguments['USERS'] else None)
+            kdf_iterations = int(arguments['--kdf-iterations'])
+            if arguments['--kdf-target']:
+                kdf_iterations = calibrate(float(arguments['--kdf-target']))
+                print('Using {} PBKDF2 iterations'.format(kdf_iterations))
+
+            with stage('generate'):
+                generate(number_of_accounts=int(arguments['ACCOUNTS']) if arguments['ACCOUNTS'] else None,
+                         key_threshold=int(arguments['THRESHOLD']) if arguments['THRESHOLD'] else None,
+                         number_of_users=int(arguments['USERS']) if arguments['USERS'] else None,
+                         parallel=arguments['--parallel'],
+                         prefetch=arguments['--prefetch'],
+                         options=BundleOptions(lazy_qr=arguments['--lazy-qr'],
+                                               qr_error_correction=arguments['--qr-error-correction'].upper(),
+                                               qr_formats=arguments['--qr-format'].lower().split(','),
+                                               contact_sheet=arguments['--contact-sheet'].lower() if arguments['--contact-sheet'] else None,
+                                               output=arguments['--output'].lower(),
+                                               kdf_iterations=kdf_iterations))
         else:
-            recover()
+            with stage('recover'):
+                recover(users=parse_users(arguments['--recover-users']) if arguments['--recover-users'] else None)
     except KeyboardInterrupt:
         print(term.red)
         print('Aborted')
         print(term.normal)
+    finally:
+        if profiler.enabled:
+            json.dump(profiler.report(), sys.stderr, indent=2, sort_keys=True)
+            sys.stderr.write('\n')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+import errno
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+from functools import partial
+from io import BytesIO
+
+MANIFEST_FILENAME = 'SHA256SUMS'
+ARCHIVE_FORMATS = ('tar', 'zip')
+CHUNK_SIZE = 64 * 1024
+
+def _check_free(paths):
+    """Raise OSError if any of paths exists, so that an export never replaces another user's files"""
+    for path in paths:
+        if os.path.lexists(path):
+            raise OSError(errno.EEXIST, 'Refusing to overwrite an existing file', path)
+
+def _create(path):
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb')
+
+class DirectoryOutput(object):
+    """Write a bundle's files to a fresh temporary directory"""
+    needs_export = False
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp()
+
+    def open(self, name):
+        return open(os.path.join(self.directory, name), 'wb')
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            return f.read()
+
+    def names(self):
+        return sorted(os.listdir(self.directory))
+
+    def describe(self, name):
+        return os.path.join(self.directory, name)
+
+    def export(self, destination):
+        """Copy every file into the destination directory and return the new paths"""
+        names = self.names()
+        paths = [os.path.join(destination, name) for name in names]
+        _check_free(paths)
+
+        for name, path in zip(names, paths):
+            with open(os.path.join(self.directory, name), 'rb') as source, _create(path) as target:
+                shutil.copyfileobj(source, target)
+        return paths
+
+    def finish(self):
+        pass
+
+    def destroy(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class _MemoryFile(BytesIO):
+    """Buffer a file's contents and hand them to on_close(name, data) once it is closed"""
+    def __init__(self, name, on_close):
+        BytesIO.__init__(self)
+        self._name = name
+        self._on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            self._on_close(self._name, self.getvalue())
+        BytesIO.close(self)
+
+class _SpooledFile(object):
+    """Write a file's contents to a temporary file in directory and hand on_close(name, path) the path once it is closed"""
+    def __init__(self, name, directory, on_close):
+        fd, self._path = tempfile.mkstemp(dir=directory)
+        self._file = os.fdopen(fd, 'w+b')
+        self._name = name
+        self._on_close = on_close
+
+    def __getattr__(self, attribute):
+        return getattr(self._file, attribute)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            self._on_close(self._name, self._path)
+
+class MemoryOutput(object):
+    """Hold a bundle's files in memory so nothing reaches the disk until export()"""
+    # The files are lost on destroy() unless the user exports them first
+    needs_export = True
+
+    def __init__(self):
+        self.files = {}
+
+    def open(self, name):
+        return _MemoryFile(name, self.files.__setitem__)
+
+    def read(self, name):
+        return self.files[name]
+
+    def names(self):
+        return sorted(self.files)
+
+    def describe(self, name):
+        return '{} (in memory)'.format(name)
+
+    def export(self, destination):
+        """Write every file into the destination directory and return the new paths"""
+        names = self.names()
+        paths = [os.path.join(destination, name) for name in names]
+        _check_free(paths)
+
+        for name, path in zip(names, paths):
+            with _create(path) as f:
+                f.write(self.files[name])
+        return paths
+
+    def finish(self):
+        pass
+
+    def destroy(self):
+        self.files.clear()
+
+class ArchiveOutput(object):
+    """Stream a bundle's files into a single tar or zip archive.
+
+    Each file is spooled to disk next to the archive while it is written
+    and appended as a member as soon as it is closed, so neither a member
+    nor the archive is ever held in memory and the archive is written
+    front to back through one open file. finish() adds
+    a SHA256SUMS manifest, in the format "sha256sum -c" reads, and closes
+    the archive; nothing can be added after that.
+    """
+    needs_export = False
+
+    def __init__(self, archive_format='tar'):
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError('Archive format must be one of {}'.format(', '.join(ARCHIVE_FORMATS)))
+
+        self.archive_format = archive_format
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'failsafe_bundle.{}'.format(archive_format))
+        self.checksums = {}
+        self._archive = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Outputs are shipped to and from the pool workers, which only
+        # happens before the first write or after finish()
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def open(self, name):
+        return _SpooledFile(name, self.directory, self._add)
+
+    def _add(self, name, path):
+        checksum = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, CHUNK_SIZE), b''):
+                checksum.update(chunk)
+
+        with self._lock:
+            if self._archive is None:
+                if self.archive_format == 'tar':
+                    self._archive = tarfile.open(self.path, 'w')
+                else:
+                    self._archive = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED)
+
+            if self.archive_format == 'tar':
+                info = tarfile.TarInfo(name)
+                info.size = os.path.getsize(path)
+                info.mtime = time.time()
+                info.mode = 0o600
+                with open(path, 'rb') as f:
+                    self._archive.addfile(info, f)
+            else:
+                # zipfile can only stream a member from a path. mkstemp
+                # made it 0600, which write() copies into the member.
+                self._archive.write(path, name)
+
+            self.checksums[name] = checksum.hexdigest()
+        os.remove(path)
+
+    def read(self, name):
+        if self.archive_format == 'tar':
+            archive = tarfile.open(self.path)
+            try:
+                return archive.extractfile(name).read()
+            finally:
+                archive.close()
+
+        archive = zipfile.ZipFile(self.path)
+        try:
+            return archive.read(name)
+        finally:
+            archive.close()
+
+    def names(self):
+        return sorted(self.checksums)
+
+    def describe(self, name):
+        return '{} in {}'.format(name, self.path)
+
+    def export(self, destination):
+        """Copy the archive into the destination directory and return its new path"""
+        path = os.path.join(destination, os.path.basename(self.path))
+        _check_free([path])
+
+        with open(self.path, 'rb') as source, _create(path) as target:
+            shutil.copyfileobj(source, target)
+        return [path]
+
+    def finish(self):
+        manifest = ''.join('{}  {}\n'.format(self.checksums[name], name) for name in self.names())
+        with self.open(MANIFEST_FILENAME) as f:
+            f.write(manifest.encode('ascii'))
+
+        with self._lock:
+            self._archive.close()
+            self._archive = None
+
+    def destroy(self):
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+OUTPUT_BACKENDS = {'directory': DirectoryOutput,
+                   'memory': MemoryOutput,
+                   'tar': partial(ArchiveOutput, 'tar'),
+                   'zip': partial(ArchiveOutput, 'zip'),
+                   }
@@ -0,0 +1,52 @@
+"""Shard passphrases with a built-in checksum.
+
+Like a BIP39 mnemonic, the eight words encode 88 bits: 80 random bits
+followed by the first 8 bits of their SHA256. A mistyped word is caught
+by the checksum (all but 1 in 256 times) without running the KDF.
+"""
+import hashlib
+import os
+
+from .words import wordlist
+
+WORD_COUNT = 8
+WORD_BITS = 11
+CHECKSUM_BITS = 8
+ENTROPY_BITS = WORD_COUNT * WORD_BITS - CHECKSUM_BITS
+
+_positions = dict((word, position) for position, word in enumerate(wordlist))
+
+def _checksum(entropy):
+    digest = bytearray(hashlib.sha256(entropy).digest())
+    return digest[0] >> (8 - CHECKSUM_BITS)
+
+def new_passphrase(entropy=None):
+    """Return a checksummed passphrase, from 10 random bytes unless entropy is given"""
+    if entropy is None:
+        entropy = os.urandom(ENTROPY_BITS // 8)
+
+    bits = 0
+    for byte in bytearray(entropy):
+        bits = (bits << 8) | byte
+    bits = (bits << CHECKSUM_BITS) | _checksum(entropy)
+
+    words = []
+    for x in range(WORD_COUNT):
+        words.append(wordlist[bits & ((1 << WORD_BITS) - 1)])
+        bits >>= WORD_BITS
+    return ' '.join(reversed(words))
+
+def verify_checksum(passphrase):
+    """Return True if passphrase is a checksummed passphrase with a matching checksum"""
+    words = passphrase.split()
+    if len(words) != WORD_COUNT or not all(word in _positions for word in words):
+        return False
+
+    bits = 0
+    for word in words:
+        bits = (bits << WORD_BITS) | _positions[word]
+
+    checksum = bits & ((1 << CHECKSUM_BITS) - 1)
+    entropy = bits >> CHECKSUM_BITS
+    entropy = bytearray((entropy >> shift) & 0xff for shift in range(ENTROPY_BITS - 8, -1, -8))
+    return _checksum(bytes(entropy)) == checksum
@@ -0,0 +1,99 @@
+import threading
+import time
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.child_seconds = 0.0
+
+    def __enter__(self):
+        self.profiler._stack().append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.start
+        stack = self.profiler._stack()
+        stack.pop()
+        if stack:
+            stack[-1].child_seconds += elapsed
+        self.profiler.add(self.name, elapsed, elapsed - self.child_seconds)
+        return False
+
+class Profiler(object):
+    """Collect wall time per named stage.
+
+    Stages may nest; "self_seconds" excludes time spent in nested stages.
+    While disabled, stage() hands back a shared no-op context manager so
+    instrumented code pays nothing beyond the attribute lookup.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def add(self, name, seconds, self_seconds=None, calls=1):
+        if self_seconds is None:
+            self_seconds = seconds
+
+        with self._lock:
+            entry = self.stages.setdefault(name, {'calls': 0,
+                                                  'total_seconds': 0.0,
+                                                  'self_seconds': 0.0,
+                                                  })
+            entry['calls'] += calls
+            entry['total_seconds'] += seconds
+            entry['self_seconds'] += self_seconds
+
+    def drain(self):
+        """Return and clear the collected stages, e.g. to ship them out of a worker process"""
+        with self._lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def merge(self, stages):
+        for name, entry in stages.items():
+            self.add(name,
+                     entry['total_seconds'],
+                     self_seconds=entry['self_seconds'],
+                     calls=entry['calls'])
+
+    def report(self):
+        return {'wall_seconds': time.time() - self.started,
+                'stages': self.stages,
+                }
+
+profiler = Profiler()
+stage = profiler.stage
@@ -0,0 +1,181 @@
+import threading
+
+from PIL import Image
+
+from qrcode import QRCode, util
+from qrcode.constants import (ERROR_CORRECT_L,
+                              ERROR_CORRECT_M,
+                              ERROR_CORRECT_Q,
+                              ERROR_CORRECT_H,
+                              )
+
+from .profiling import stage
+
+ERROR_CORRECTION_LEVELS = {'L': ERROR_CORRECT_L,
+                           'M': ERROR_CORRECT_M,
+                           'Q': ERROR_CORRECT_Q,
+                           'H': ERROR_CORRECT_H,
+                           }
+BOX_SIZE = 10
+BORDER = 4
+DEFAULT_QR_FORMATS = ('png',)
+
+class _TemplateQRCode(QRCode):
+    """QRCode that lays out the function patterns for a version and mask once.
+
+    The finder, timing and alignment patterns and the format information
+    only depend on the version, error correction level and mask, so they
+    are copied from a shared template instead of being redrawn.
+    """
+    def __init__(self, templates, *args, **kwargs):
+        self._templates = templates
+        QRCode.__init__(self, *args, **kwargs)
+
+    def makeImpl(self, test, mask_pattern):
+        key = (self.version, self.error_correction, mask_pattern, test)
+        template = self._templates.get(key)
+
+        self.modules_count = self.version * 4 + 17
+        if template is None:
+            self.modules = [[None] * self.modules_count for row in range(self.modules_count)]
+            self.setup_position_probe_pattern(0, 0)
+            self.setup_position_probe_pattern(self.modules_count - 7, 0)
+            self.setup_position_probe_pattern(0, self.modules_count - 7)
+            self.setup_position_adjust_pattern()
+            self.setup_timing_pattern()
+            self.setup_type_info(test, mask_pattern)
+            if self.version >= 7:
+                self.setup_type_number(test)
+            self._templates[key] = [row[:] for row in self.modules]
+        else:
+            self.modules = [row[:] for row in template]
+
+        if self.data_cache is None:
+            self.data_cache = util.create_data(self.version, self.error_correction, self.data_list)
+        self.map_data(self.data_cache, mask_pattern)
+
+class QRRenderer(object):
+    """Render QR codes for payloads of a known kind ('wif', 'address', 'shard').
+
+    Payloads of one kind and length always need the same symbol version,
+    so the best-fit version search and the mask pattern evaluation only
+    run for the first payload of each kind and length. Later payloads are
+    encoded straight into the cached version and mask.
+    """
+    def __init__(self, error_correction='M'):
+        self.error_correction = ERROR_CORRECTION_LEVELS[error_correction]
+        self._lock = threading.Lock()
+        self._layouts = {}
+        self._templates = {}
+
+    def encode(self, kind, data):
+        mode = util.optimal_mode(data)
+        key = (kind, len(data), mode)
+        with self._lock:
+            version, mask_pattern = self._layouts.get(key, (None, None))
+
+        code = _TemplateQRCode(self._templates,
+                               version=version,
+                               error_correction=self.error_correction,
+                               mask_pattern=mask_pattern)
+        # Encode the payload as a single segment so every payload of this
+        # length and mode needs the same number of bits as the one the
+        # layout was picked for
+        code.add_data(util.QRData(data, mode=mode))
+
+        if version is None:
+            code.best_fit()
+            code.mask_pattern = code.best_mask_pattern()
+            with self._lock:
+                self._layouts[key] = (code.version, code.mask_pattern)
+
+        code.makeImpl(False, code.mask_pattern)
+        return code
+
+    def modules(self, kind, data):
+        """Return the QR code's modules (True for dark) without a quiet zone"""
+        return self.encode(kind, data).modules
+
+    def make(self, kind, data):
+        return make_image(self.modules(kind, data))
+
+    def save(self, kind, data, output, basename, formats=DEFAULT_QR_FORMATS):
+        """Write the QR code to basename + '.' + extension in output for each of formats"""
+        with stage('qr_make'):
+            modules = self.modules(kind, data)
+
+        for qr_format in formats:
+            extension, writer = QR_FORMATS[qr_format]
+            with stage('{}_save'.format(qr_format)), output.open('{}.{}'.format(basename, extension)) as fp:
+                writer(modules, fp)
+
+def _with_border(modules, border=BORDER):
+    width = len(modules) + 2 * border
+    blank = [False] * width
+    side = [False] * border
+    return ([blank] * border +
+            [side + row + side for row in modules] +
+            [blank] * border)
+
+def make_image(modules, box_size=BOX_SIZE):
+    """Return a 1-bit PIL image of the QR code, scaled to box_size pixels per module"""
+    matrix = _with_border(modules)
+    width = len(matrix)
+    pixels = bytearray(0 if module else 255 for row in matrix for module in row)
+    img = Image.frombytes('L', (width, width), bytes(pixels))
+    return img.resize((width * box_size, width * box_size), Image.NEAREST).convert('1')
+
+def write_png(modules, fp):
+    make_image(modules).save(fp, format='PNG')
+
+def write_svg(modules, fp):
+    matrix = _with_border(modules)
+    width = len(matrix)
+
+    # One path for the whole symbol with a sub-path per horizontal run of
+    # dark modules keeps the file small
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < width:
+            if row[x]:
+                run = 1
+                while x + run < width and row[x + run]:
+                    run += 1
+                path.append('M{} {}h{}v1h-{}z'.format(x, y, run, run))
+                x += run
+            else:
+                x += 1
+
+    fp.write(('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+              'viewBox="0 0 {width} {width}" shape-rendering="crispEdges">'
+              '<rect width="{width}" height="{width}" fill="#fff"/>'
+              '<path d="{path}" fill="#000"/>'
+              '</svg>\n').format(size=width * BOX_SIZE,
+                                  width=width,
+                                  path=''.join(path)).encode('ascii'))
+
+def write_pbm(modules, fp):
+    """Write a binary (P4) PBM scaled to BOX_SIZE pixels per module"""
+    matrix = _with_border(modules)
+    size = len(matrix) * BOX_SIZE
+    fp.write('P4\n{} {}\n'.format(size, size).encode('ascii'))
+
+    for row in matrix:
+        bits = [module for module in row for x in range(BOX_SIZE)]
+        bits += [False] * (-len(bits) % 8)
+        packed = bytearray(sum(0x80 >> offset for offset, bit in enumerate(bits[idx:idx + 8]) if bit)
+                           for idx in range(0, len(bits), 8))
+        fp.write(bytes(packed) * BOX_SIZE)
+
+def write_matrix(modules, fp):
+    """Write the raw modules, one line of 1 (dark) and 0 (light) characters per row, without a quiet zone"""
+    for row in modules:
+        fp.write(''.join('1' if module else '0' for module in row).encode('ascii') + b'\n')
+
+QR_FORMATS = {'png': ('png', write_png),
+              'svg': ('svg', write_svg),
+              'pbm': ('pbm', write_pbm),
+              'matrix': ('txt', write_matrix),
+              }
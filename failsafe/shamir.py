@@ -0,0 +1,225 @@
+"""Shamir secret sharing over GF(256).
+
+Every byte of the secret is shared on its own polynomial over GF(256),
+so a share is exactly as long as the secret and splitting and recovery
+are table lookups instead of big integer arithmetic. Shares are written
+as "<x>:<urlsafe base64 without padding>".
+
+The field is the one used by AES (x^8 + x^4 + x^3 + x + 1) and 3
+generates its multiplicative group.
+
+When NumPy is installed, all shares of all secret bytes are evaluated,
+and all shares combined, in a handful of array operations over a full
+256x256 multiplication table. Without it the same arithmetic runs a byte
+at a time through per-factor lookup tables.
+"""
+import base64
+import os
+
+try:
+    import numpy
+except ImportError: # pragma: no cover
+    numpy = None
+
+FIELD_POLYNOMIAL = 0x11b
+GENERATOR = 3
+MAX_SHARES = 255
+SHARE_SEPARATOR = ':'
+
+def _tables():
+    exp = [0] * 510
+    log = [0] * 256
+    value = 1
+    for power in range(255):
+        exp[power] = exp[power + 255] = value
+        log[value] = power
+
+        # value * 3 == value * 2 ^ value
+        doubled = value << 1
+        if doubled & 0x100:
+            doubled ^= FIELD_POLYNOMIAL
+        value = doubled ^ value
+    return exp, log
+
+EXP, LOG = _tables()
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+def gf_div(a, b):
+    if b == 0:
+        raise ZeroDivisionError('Division by zero in GF(256)')
+    if a == 0:
+        return 0
+    return EXP[LOG[a] - LOG[b] + 255]
+
+def _multiplication_table(factor):
+    """Return a 256 entry list mapping every byte to byte * factor"""
+    return [gf_mul(value, factor) for value in range(256)]
+
+def _evaluate_python(coefficients, xs):
+    """Evaluate every byte position's polynomial at each of xs.
+
+    coefficients[k] holds the k-th coefficient of each byte's polynomial.
+    Returns a bytearray of y values per x.
+    """
+    results = []
+    for x in xs:
+        times_x = _multiplication_table(x)
+        result = bytearray(len(coefficients[0]))
+        for coefficient in reversed(coefficients):
+            result = bytearray(times_x[value] ^ term for value, term in zip(result, coefficient))
+        results.append(result)
+    return results
+
+def _barycentric_weights_python(xs):
+    """Return 1 / prod(xi - xj for every other xj) for each xi"""
+    weights = []
+    for i, xi in enumerate(xs):
+        denominator = 1
+        for j, xj in enumerate(xs):
+            if i != j:
+                denominator = gf_mul(denominator, xi ^ xj)
+        weights.append(gf_div(1, denominator))
+    return weights
+
+def _stack_python(ys):
+    return [bytearray(share_ys) for share_ys in ys]
+
+def _combine_python(weights, ys):
+    """Return the sum of each share's y values scaled by its weight.
+
+    ys are the shares' y values as returned by _stack.
+    """
+    result = bytearray(len(ys[0]))
+    for weight, share_ys in zip(weights, ys):
+        times_weight = _multiplication_table(weight)
+        result = bytearray(value ^ times_weight[y] for value, y in zip(result, share_ys))
+    return result
+
+if numpy is not None:
+    _EXP_ARRAY = numpy.array(EXP, dtype=numpy.uint8)
+    _LOG_ARRAY = numpy.array(LOG, dtype=numpy.int32)
+    # Flattened so that a * b is _MUL_ARRAY[a << 8 | b], a single take()
+    _MUL_ARRAY = numpy.array([_multiplication_table(factor) for factor in range(256)], dtype=numpy.uint8).ravel()
+
+    def _evaluate_numpy(coefficients, xs):
+        coefficients = numpy.array([numpy.frombuffer(bytes(coefficient), dtype=numpy.uint8)
+                                    for coefficient in coefficients])
+        x_rows = numpy.array(xs, dtype=numpy.intp)[:, numpy.newaxis] << 8
+
+        # One row of y values per x, Horner's rule across the coefficients
+        result = numpy.zeros((len(xs), coefficients.shape[1]), dtype=numpy.uint8)
+        for coefficient in coefficients[::-1]:
+            result = _MUL_ARRAY.take(x_rows | result) ^ coefficient
+        return [bytearray(row.tobytes()) for row in result]
+
+    def _barycentric_weights_numpy(xs):
+        xs = numpy.array(xs, dtype=numpy.int32)
+
+        # Products become sums of logarithms. The diagonal of differences
+        # is zero and is left out of the denominators.
+        differences = _LOG_ARRAY[xs[:, numpy.newaxis] ^ xs]
+        numpy.fill_diagonal(differences, 0)
+        return [int(weight) for weight in _EXP_ARRAY[-differences.sum(axis=1) % 255]]
+
+    def _stack_numpy(ys):
+        return numpy.array([numpy.frombuffer(bytes(share_ys), dtype=numpy.uint8) for share_ys in ys])
+
+    def _combine_numpy(weights, ys):
+        weight_rows = numpy.array(weights, dtype=numpy.intp)[:, numpy.newaxis] << 8
+        return bytearray(numpy.bitwise_xor.reduce(_MUL_ARRAY.take(weight_rows | ys), axis=0).tobytes())
+
+    _evaluate = _evaluate_numpy
+    _barycentric_weights = _barycentric_weights_numpy
+    _stack = _stack_numpy
+    _combine = _combine_numpy
+else:
+    _evaluate = _evaluate_python
+    _barycentric_weights = _barycentric_weights_python
+    _stack = _stack_python
+    _combine = _combine_python
+
+def encode_share(x, ys):
+    return '{}{}{}'.format(x, SHARE_SEPARATOR, base64.urlsafe_b64encode(bytes(ys)).rstrip('='))
+
+def _check_x(x):
+    if not 1 <= x <= MAX_SHARES:
+        raise ValueError('Share index out of range: {}'.format(x))
+
+def decode_share(share):
+    x, encoded = share.split(SHARE_SEPARATOR, 1)
+    x = int(x)
+    _check_x(x)
+    return x, bytearray(base64.urlsafe_b64decode(str(encoded) + '=' * (-len(encoded) % 4)))
+
+def is_gf256_share(share):
+    return SHARE_SEPARATOR in share
+
+class RecoveryContext(object):
+    """Evaluate the polynomials behind a set of shares at any x.
+
+    The barycentric weights of the shares' x coordinates are computed
+    once, so the secret and every replacement share after it only cost a
+    linear pass over the shares to weight them and one combination of
+    their y values.
+    """
+    def __init__(self, shares):
+        points = [decode_share(share) for share in shares]
+        self.xs = [x for x, ys in points]
+        if len(set(self.xs)) != len(self.xs):
+            raise ValueError('Duplicate shares were provided')
+        if len(set(len(ys) for x, ys in points)) != 1:
+            raise ValueError('Shares are not all the same length')
+
+        self._ys = _stack([ys for x, ys in points])
+        self._barycentric_weights = _barycentric_weights(self.xs)
+
+    def weights(self, x):
+        """Return the weight of each share's y in the value of the polynomial at x"""
+        if x in self.xs:
+            return [int(x == xi) for xi in self.xs]
+
+        # l(x) * w_i / (x - x_i) where l(x) is the product of every (x - x_i)
+        numerator = 1
+        for xi in self.xs:
+            numerator = gf_mul(numerator, x ^ xi)
+        return [gf_div(gf_mul(numerator, weight), x ^ xi)
+                for xi, weight in zip(self.xs, self._barycentric_weights)]
+
+    def secret(self):
+        return bytes(_combine(self.weights(0), self._ys))
+
+    def share(self, x):
+        """Return the share with index x"""
+        _check_x(x)
+        return encode_share(x, _combine(self.weights(x), self._ys))
+
+class GF256SecretSharer(object):
+    """Split a byte string into shares and recover it from any threshold of them.
+
+    Mirrors the interface of the secretsharing package's sharers so it
+    can be used in their place.
+    """
+    @staticmethod
+    def split_secret(secret, threshold, share_count):
+        if threshold < 2:
+            raise ValueError('Threshold must be >= 2')
+        if not threshold <= share_count <= MAX_SHARES:
+            raise ValueError('Threshold must be at most the share count, which is at most {}'.format(MAX_SHARES))
+
+        coefficients = [bytearray(secret)]
+        coefficients.extend(bytearray(os.urandom(len(secret))) for x in range(threshold - 1))
+        xs = range(1, share_count + 1)
+        return [encode_share(x, ys) for x, ys in zip(xs, _evaluate(coefficients, xs))]
+
+    @staticmethod
+    def recover_secret(shares):
+        return RecoveryContext(shares).secret()
+
+    @staticmethod
+    def recover_share(shares, x):
+        """Return the share with index x of the secret shares were split from"""
+        return RecoveryContext(shares).share(x)
@@ -0,0 +1,107 @@
+import threading
+
+from PIL import Image, ImageDraw
+
+from .profiling import stage
+from .qr import BORDER, make_image
+
+SHEET_FORMATS = ('pdf', 'png')
+PAGE_SIZE = (1240, 1754) # A4 at 150 dpi
+RESOLUTION = 150.0
+COLUMNS = 4
+ROWS = 6
+LABEL_HEIGHT = 24
+
+class ContactSheet(object):
+    """Tile account QR codes onto labelled pages instead of one file per code.
+
+    Each account takes two neighbouring cells, its private key followed by
+    its address. Accounts may be written in any order from several threads;
+    each lands in the cell for its index. PNG pages are saved as soon as
+    they are full, a PDF is saved as one document by close().
+    """
+    def __init__(self, output, renderer, sheet_format='pdf', basename='accounts'):
+        if sheet_format not in SHEET_FORMATS:
+            raise ValueError('Contact sheet format must be one of {}'.format(', '.join(SHEET_FORMATS)))
+
+        self.output = output
+        self.renderer = renderer
+        self.sheet_format = sheet_format
+        self.basename = basename
+        self.filenames = []
+
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._filled = {}
+        self._closed = False
+
+    @property
+    def accounts_per_page(self):
+        return COLUMNS * ROWS // 2
+
+    def _cell_image(self, kind, data):
+        with stage('qr_make'):
+            modules = self.renderer.modules(kind, data)
+
+        cell_width = PAGE_SIZE[0] // COLUMNS
+        cell_height = PAGE_SIZE[1] // ROWS - LABEL_HEIGHT
+        box_size = max(1, min(cell_width, cell_height) // (len(modules) + 2 * BORDER))
+        return make_image(modules, box_size=box_size)
+
+    def _paste(self, page, cell, img, label):
+        cell_width = PAGE_SIZE[0] // COLUMNS
+        cell_height = PAGE_SIZE[1] // ROWS
+        left = (cell % COLUMNS) * cell_width
+        top = (cell // COLUMNS) * cell_height
+
+        left += (cell_width - img.size[0]) // 2
+        page.paste(img, (left, top))
+        ImageDraw.Draw(page).text((left, top + img.size[1]), label, fill=0)
+
+    def write(self, account):
+        private_img = self._cell_image('wif', account.wif)
+        public_img = self._cell_image('address', account.address)
+
+        page_index, position = divmod(account.index, self.accounts_per_page)
+        with self._lock, stage('sheet_paste'):
+            if self._closed:
+                return
+
+            page = self._pages.get(page_index)
+            if page is None:
+                page = self._pages[page_index] = Image.new('1', PAGE_SIZE, 1)
+
+            self._paste(page, position * 2, private_img, 'Account {} private key'.format(account.index + 1))
+            self._paste(page, position * 2 + 1, public_img, 'Account {} address'.format(account.index + 1))
+
+            self._filled[page_index] = self._filled.get(page_index, 0) + 1
+            if self.sheet_format == 'png' and self._filled[page_index] == self.accounts_per_page:
+                self._save_png(page_index)
+
+    def _save_png(self, page_index):
+        filename = '{}_page{}.png'.format(self.basename, page_index + 1)
+        with stage('sheet_save'), self.output.open(filename) as fp:
+            self._pages.pop(page_index).save(fp, format='PNG', dpi=(RESOLUTION, RESOLUTION))
+        self.filenames.append(filename)
+
+    def close(self):
+        """Save any pages still held in memory. Further writes are ignored."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+            if self.sheet_format == 'png':
+                for page_index in sorted(self._pages):
+                    self._save_png(page_index)
+            elif self._pages:
+                pages = [self._pages[page_index] for page_index in sorted(self._pages)]
+                filename = '{}.pdf'.format(self.basename)
+                with stage('sheet_save'), self.output.open(filename) as fp:
+                    pages[0].save(fp,
+                                  format='PDF',
+                                  save_all=True,
+                                  append_images=pages[1:],
+                                  resolution=RESOLUTION)
+                self.filenames.append(filename)
+                self._pages = {}
@@ -0,0 +1,118 @@
+"""Search for the passphrase a user meant to type.
+
+Passphrase prompts only accept words from the word list, completing
+unique prefixes as they are typed, so every typed word is a real word
+that may be the wrong one. Candidates are generated from the typed words
+in order of likelihood: neighbouring words are swapped, and then each
+word is replaced by the closest entries by edit distance.
+
+Every candidate costs a full key derivation, so they are checked on a
+KDF executor a window at a time and the search stops at the first one
+that decrypts the token.
+"""
+import itertools
+
+from collections import deque
+
+from cryptography.fernet import InvalidToken
+
+from .envelope import decrypt_token
+from .wordindex import index
+
+MAX_DISTANCE = 2
+MAX_CANDIDATES = 5000
+
+def edit_distance(a, b):
+    """Levenshtein distance between a and b"""
+    previous = range(len(b) + 1)
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+def word_options(word, max_distance=MAX_DISTANCE):
+    """Return (cost, replacement) pairs for word, cheapest first.
+
+    Every other word list entry costs its edit distance from word.
+    """
+    options = []
+    for entry in index.words:
+        if entry == word:
+            continue
+
+        if abs(len(entry) - len(word)) <= max_distance:
+            distance = edit_distance(word, entry)
+            if distance <= max_distance:
+                options.append((distance, entry))
+
+    options.sort()
+    return options
+
+def _swap_candidates(words):
+    for position in range(len(words) - 1):
+        if words[position] != words[position + 1]:
+            candidate = list(words)
+            candidate[position], candidate[position + 1] = candidate[position + 1], candidate[position]
+            yield candidate
+
+def _substitution_candidates(words, max_distance):
+    options = [word_options(word, max_distance) for word in words]
+    substitutions = sorted((cost, position, replacement)
+                           for position, word_options_ in enumerate(options)
+                           for cost, replacement in word_options_)
+    for cost, position, replacement in substitutions:
+        candidate = list(words)
+        candidate[position] = replacement
+        yield candidate
+
+def candidates(words, max_distance=MAX_DISTANCE, limit=MAX_CANDIDATES):
+    """Yield up to limit distinct passphrase candidates (lists of words) near words"""
+    words = [word.strip().lower() for word in words]
+    generated = itertools.chain(_swap_candidates(words),
+                                _substitution_candidates(words, max_distance))
+
+    seen = set([tuple(words)])
+    for candidate in generated:
+        if len(seen) > limit:
+            break
+
+        key = tuple(candidate)
+        if key not in seen:
+            seen.add(key)
+            yield candidate
+
+def search_passphrase(words, envelope, kdf_executor, limit=MAX_CANDIDATES, candidate_filter=None):
+    """Return (passphrase, plaintext) for the first candidate near words that decrypts envelope, or None.
+
+    Keys are derived on kdf_executor a window at a time and checked in the
+    order the candidates were generated, so a likelier candidate always
+    wins over a less likely one that happened to finish first. Candidates
+    for which candidate_filter(passphrase) is false are skipped without a
+    derivation.
+    """
+    window = kdf_executor.processes * 2
+    generated = candidates(words, limit=limit)
+    in_flight = deque()
+
+    while True:
+        while len(in_flight) < window:
+            candidate = next(generated, None)
+            if candidate is None:
+                break
+            passphrase = ' '.join(candidate)
+            if candidate_filter and not candidate_filter(passphrase):
+                continue
+            in_flight.append((passphrase, kdf_executor.submit(passphrase, envelope.salt, envelope.iterations)))
+
+        if not in_flight:
+            return None
+
+        passphrase, key = in_flight.popleft()
+        try:
+            return passphrase, decrypt_token(envelope, key.get())
+        except InvalidToken:
+            continue
@@ -1,16 +1,14 @@
 from __future__ import print_function
 
 import getpass
+import json
+import types
 
-from random import SystemRandom
-from .words import wordlist
 from blessings import Terminal
 term = Terminal()
 
 SENTINEL = object()
 
-sys_random = SystemRandom()
-
 def _get_input(prompt, input_type=SENTINEL, default=SENTINEL, secure=False):
     if input_type != SENTINEL and not isinstance(input_type, type):
         raise ValueError('Input type must be of type "type"')
@@ -44,6 +42,25 @@ def _print(*args, **kwargs):
     print(*args, **kwargs)
     print(term.normal, end='')
 
-def word_generator():
-    while True:
-        yield sys_random.choice(wordlist)
+def dump_json(obj, fp):
+    """Write the dict obj to fp as JSON.
+
+    Generator values are written as JSON arrays one item at a time so they
+    never have to be held in memory.
+    """
+    fp.write('{')
+    for idx, (key, value) in enumerate(obj.items()):
+        if idx:
+            fp.write(', ')
+        fp.write(json.dumps(key) + ': ')
+
+        if isinstance(value, types.GeneratorType):
+            fp.write('[')
+            for item_idx, item in enumerate(value):
+                if item_idx:
+                    fp.write(', ')
+                fp.write(json.dumps(item))
+            fp.write(']')
+        else:
+            fp.write(json.dumps(value))
+    fp.write('}')
@@ -0,0 +1,50 @@
+from .words import wordlist
+
+PREFIX_LENGTH = 4
+
+class WordIndex(object):
+    """Prefix index over a word list.
+
+    Every prefix of up to PREFIX_LENGTH letters maps to the words that
+    start with it, so membership, completion and resolving a typed word
+    are dictionary lookups. In the BIP39 list the first four letters are
+    enough to pick out a single word.
+    """
+    def __init__(self, words):
+        self.words = frozenset(words)
+        self._prefixes = {}
+        for word in sorted(self.words):
+            for length in range(1, min(len(word), PREFIX_LENGTH) + 1):
+                self._prefixes.setdefault(word[:length], []).append(word)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def __len__(self):
+        return len(self.words)
+
+    def completions(self, prefix):
+        """Return the sorted words that start with prefix"""
+        if not prefix:
+            return sorted(self.words)
+
+        matches = self._prefixes.get(prefix[:PREFIX_LENGTH], [])
+        if len(prefix) > PREFIX_LENGTH:
+            matches = [word for word in matches if word.startswith(prefix)]
+        return list(matches)
+
+    def resolve(self, word):
+        """Return the word that was meant by word, or None if it is unknown or ambiguous.
+
+        A word is resolved if it is in the list or is the prefix of exactly
+        one word in the list.
+        """
+        if word in self.words:
+            return word
+
+        matches = self.completions(word) if word else []
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+index = WordIndex(wordlist)
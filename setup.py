@@ -80,7 +80,7 @@ setup(
     author=AUTHOR,
     author_email=EMAIL,
     url=URL,
-    packages=find_packages(exclude=('tests',)),
+    packages=find_packages(exclude=('tests', 'benchmarks')),
     # If your package is a single module, use this instead of 'packages':
     # py_modules=['mypackage'],
 
@@ -88,6 +88,10 @@ setup(
         'console_scripts': ['failsafe=failsafe.main:main'],
     },
     install_requires=REQUIRED,
+    extras_require={
+        # Vectorized secret splitting and recovery for large groups
+        'numpy': ['numpy'],
+    },
     include_package_data=True,
     license='MIT',
     classifiers=[
@@ -0,0 +1,52 @@
+import unittest
+
+from bitmerchant.wallet import Wallet
+
+from failsafe.derivation import (AccountDeriver,
+                                 iter_accounts,
+                                 master_key_material,
+                                 wallet_from_key_material,
+                                 )
+
+class TestDeriveAccounts(unittest.TestCase):
+    def setUp(self):
+        self.master_wallet = Wallet.from_master_secret('failsafe test seed')
+        self.user_key = self.master_wallet.get_child(1, is_prime=True)
+
+    def test_matches_per_account_derivation(self):
+        accounts = list(iter_accounts(self.user_key, 0, 5))
+
+        self.assertEqual(5, len(accounts))
+        for idx, account in enumerate(accounts):
+            child = self.user_key.get_child(0).get_child(idx)
+            self.assertEqual(idx, account.index)
+            self.assertEqual(child.export_to_wif(), account.wif)
+            self.assertEqual(child.to_address(), account.address)
+
+    def test_range_offset(self):
+        expected = list(iter_accounts(self.user_key, 0, 4))[2:]
+        actual = list(iter_accounts(self.user_key, 2, 2))
+        self.assertEqual(expected, actual)
+
+    def test_empty_range(self):
+        self.assertEqual([], list(iter_accounts(self.user_key, 0, 0)))
+
+    def test_invalid_index(self):
+        deriver = AccountDeriver(self.user_key)
+        self.assertRaises(ValueError, deriver.derive, -1)
+        self.assertRaises(ValueError, deriver.derive, 0x80000000)
+
+class TestMasterKeyMaterial(unittest.TestCase):
+    def test_round_trip(self):
+        master_wallet = Wallet.from_master_secret('failsafe test seed')
+        key_material = master_key_material(master_wallet)
+
+        self.assertEqual(64, len(key_material))
+        self.assertEqual(master_wallet.serialize_b58(), wallet_from_key_material(key_material).serialize_b58())
+
+    def test_leading_zeros(self):
+        key_material = b'\0' * 31 + b'\1' + b'\0' * 31 + b'\5'
+        self.assertEqual(key_material, master_key_material(wallet_from_key_material(key_material)))
+
+    def test_invalid_length(self):
+        self.assertRaises(ValueError, wallet_from_key_material, b'\0' * 63)
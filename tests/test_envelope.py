@@ -0,0 +1,98 @@
+import base64
+import unittest
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from failsafe.envelope import (AES_GCM,
+                               FERNET,
+                               Envelope,
+                               decrypt_token,
+                               encode_compact_envelope,
+                               encrypt_token,
+                               parse_envelope,
+                               )
+from failsafe.kdf import MAX_ITERATIONS, derive_key
+from failsafe.qr import QRRenderer
+
+def legacy_shard(plaintext, passphrase, salt):
+    """Encrypt plaintext the way shards were written before the envelope existed"""
+    token = Fernet(derive_key(passphrase, salt, 100000)).encrypt(plaintext)
+    return '{}${}'.format(base64.urlsafe_b64encode(salt),
+                          base64.urlsafe_b64encode(token))
+
+class TestLegacyEnvelope(unittest.TestCase):
+    def test_parse(self):
+        encrypted_shard = '{}${}'.format(base64.urlsafe_b64encode(b'salt'),
+                                         base64.urlsafe_b64encode(b'token'))
+        self.assertEqual(Envelope(100000, b'salt', b'token', False, FERNET), parse_envelope(encrypted_shard))
+
+    def test_decrypt(self):
+        salt = b'salt' * 4
+        envelope = parse_envelope(' {}\n'.format(legacy_shard(b'2-shard1', 'passphrase', salt)))
+
+        self.assertEqual(b'2-shard1', decrypt_token(envelope, derive_key('passphrase', salt, 100000)))
+        self.assertRaises(InvalidToken, decrypt_token, envelope, derive_key('wrong', salt, 100000))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, parse_envelope, 'v2$pbkdf2-sha256$1$plain$c2FsdA==$dG9rZW4=')
+        self.assertRaises(ValueError, parse_envelope, 'c2FsdA$dG9rZW4=')
+        self.assertRaises(ValueError, parse_envelope, 'not a shard')
+
+class TestCompactEnvelope(unittest.TestCase):
+    def setUp(self):
+        self.salt = b'salt' * 4
+        self.key = derive_key(b'passphrase', self.salt, 1000)
+
+    def test_round_trip(self):
+        token = encrypt_token(b'2-shard1', self.key)
+        encrypted_shard = encode_compact_envelope(self.salt, token, 250000)
+
+        self.assertNotIn('$', encrypted_shard)
+        self.assertNotIn('=', encrypted_shard)
+        self.assertEqual(encrypted_shard.upper(), encrypted_shard)
+        self.assertEqual(Envelope(250000, self.salt, token, True, AES_GCM), parse_envelope(encrypted_shard))
+        self.assertEqual(b'2-shard1', decrypt_token(parse_envelope(encrypted_shard), self.key))
+
+    def test_lower_case(self):
+        encrypted_shard = encode_compact_envelope(self.salt, encrypt_token(b'2-shard1', self.key), 1000, checksum=False)
+        envelope = parse_envelope(' {}\n'.format(encrypted_shard.lower()))
+
+        self.assertFalse(envelope.checksum)
+        self.assertEqual(b'2-shard1', decrypt_token(envelope, self.key))
+
+    def test_shorter_than_legacy_shard(self):
+        fernet_shard = legacy_shard(b'2-shard1' * 8, b'passphrase', self.salt)
+        compact_shard = encode_compact_envelope(self.salt, encrypt_token(b'2-shard1' * 8, self.key), 100000)
+        self.assertLess(len(compact_shard), len(fernet_shard))
+
+        renderer = QRRenderer()
+        self.assertLess(renderer.encode('shard', compact_shard).version,
+                        renderer.encode('shard', fernet_shard).version)
+
+    def test_wrong_key(self):
+        envelope = parse_envelope(encode_compact_envelope(self.salt, encrypt_token(b'2-shard1', self.key), 1000))
+        wrong_key = derive_key(b'wrong', self.salt, 1000)
+
+        self.assertRaises(InvalidToken, decrypt_token, envelope, wrong_key)
+        self.assertRaises(InvalidToken, decrypt_token, envelope._replace(token=envelope.token[:12]), self.key)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_envelope, 'AAAA')
+        self.assertRaises(ValueError, parse_envelope, 'notashard!')
+        unknown_version = encode_compact_envelope(self.salt, b'\0' * 28, 1000).replace('AM', 'AQ', 1)
+        self.assertRaises(ValueError, parse_envelope, unknown_version)
+
+    def test_mistyped_character(self):
+        encrypted_shard = encode_compact_envelope(self.salt, encrypt_token(b'2-shard1', self.key), 250000)
+        alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+        for position, character in enumerate(encrypted_shard):
+            # The low bits of the last character are padding, so change a high one
+            replacement = alphabet[alphabet.index(character) ^ 16]
+            mistyped = encrypted_shard[:position] + replacement + encrypted_shard[position + 1:]
+            self.assertRaises(ValueError, parse_envelope, mistyped)
+
+        self.assertRaises(ValueError, parse_envelope, '1' + encrypted_shard[1:])
+
+    def test_iterations_above_maximum(self):
+        encrypted_shard = encode_compact_envelope(self.salt, encrypt_token(b'2-shard1', self.key), MAX_ITERATIONS + 1)
+        self.assertRaises(ValueError, parse_envelope, encrypted_shard)
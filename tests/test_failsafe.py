@@ -1,15 +1,34 @@
+import base64
+import threading
 import unittest
 import mock
 
 from bitmerchant.wallet import Wallet
 
+from cryptography.fernet import Fernet, InvalidToken
+
 from blessings import Terminal
 term = Terminal()
 
-from failsafe.failsafe import (generate,
+from failsafe.failsafe import (BackgroundQRWriter,
+                               BundleOptions,
+                               ShardDecryption,
+                               ShardMismatchError,
+                               ShardSet,
+                               _encrypt_shards,
+                               decrypt_shard,
+                               generate,
                                _validate_generate_values,
                                recover,
                                )
+from failsafe.envelope import (decrypt_token,
+                               encode_compact_envelope,
+                               encrypt_token,
+                               parse_envelope,
+                               )
+from failsafe.passphrase import new_passphrase, verify_checksum
+from failsafe.derivation import master_key_material
+from failsafe.kdf import ITERATIONS, KDFExecutor, derive_key
 
 class TestValidateGenerateValues(unittest.TestCase):
     def test_negative_number_of_users(self):
@@ -43,11 +62,43 @@ class TestValidateGenerateValues(unittest.TestCase):
                           6,
                           'asdf')
 
+        self.assertRaises(ValueError,
+                          _validate_generate_values,
+                          2,
+                          10,
+                          1,
+                          'asdf')
+
     def test_valid(self):
         expected = None
         actual = _validate_generate_values(6, 10, 5, 'asdf')
         self.assertEqual(expected, actual)
 
+class TestBundleOptions(unittest.TestCase):
+    def test_invalid_error_correction(self):
+        self.assertRaises(ValueError, BundleOptions, qr_error_correction='X')
+
+    def test_invalid_qr_format(self):
+        self.assertRaises(ValueError, BundleOptions, qr_formats=('png', 'gif'))
+
+    def test_no_qr_formats(self):
+        self.assertRaises(ValueError, BundleOptions, qr_formats=())
+
+    def test_invalid_contact_sheet(self):
+        self.assertRaises(ValueError, BundleOptions, contact_sheet='gif')
+
+    def test_lazy_qr_archive(self):
+        self.assertRaises(ValueError, BundleOptions, lazy_qr=True, output='tar')
+
+    def test_kdf_iterations_below_minimum(self):
+        self.assertRaises(ValueError, BundleOptions, kdf_iterations=1000)
+
+    def test_kdf_iterations_above_maximum(self):
+        self.assertRaises(ValueError, BundleOptions, kdf_iterations=10 ** 9)
+
+    def test_qr_formats(self):
+        self.assertEqual(('svg', 'matrix'), BundleOptions(qr_formats=['svg', 'matrix']).qr_formats)
+
 class TestGenerate(unittest.TestCase):
     def setUp(self):
         self._print_patcher = mock.patch('failsafe.failsafe._print')
@@ -59,8 +110,11 @@ class TestGenerate(unittest.TestCase):
         self.Wallet_patcher = mock.patch('failsafe.failsafe.Wallet')
         self.mock_Wallet = self.Wallet_patcher.start()
 
-        self.BitcoinToB58SecretSharer_patcher = mock.patch('failsafe.failsafe.BitcoinToB58SecretSharer')
-        self.mock_BitcoinToB58SecretSharer = self.BitcoinToB58SecretSharer_patcher.start()
+        self.master_key_material_patcher = mock.patch('failsafe.failsafe.master_key_material')
+        self.mock_master_key_material = self.master_key_material_patcher.start()
+
+        self.GF256SecretSharer_patcher = mock.patch('failsafe.failsafe.GF256SecretSharer')
+        self.mock_GF256SecretSharer = self.GF256SecretSharer_patcher.start()
 
         self._validate_generate_values_patcher = mock.patch('failsafe.failsafe._validate_generate_values')
         self.mock_validate_generate_values = self._validate_generate_values_patcher.start()
@@ -68,21 +122,43 @@ class TestGenerate(unittest.TestCase):
         self._generateKeys_patcher = mock.patch('failsafe.failsafe._generateKeys')
         self.mock_generateKeys = self._generateKeys_patcher.start()
 
+        self.BundlePool_patcher = mock.patch('failsafe.failsafe.BundlePool')
+        self.mock_BundlePool = self.BundlePool_patcher.start()
+
+        self.BundlePrefetcher_patcher = mock.patch('failsafe.failsafe.BundlePrefetcher')
+        self.mock_BundlePrefetcher = self.BundlePrefetcher_patcher.start()
+
+        self._present_bundle_patcher = mock.patch('failsafe.failsafe._present_bundle')
+        self.mock_present_bundle = self._present_bundle_patcher.start()
+
+        self.KDFExecutor_patcher = mock.patch('failsafe.failsafe.KDFExecutor')
+        self.mock_KDFExecutor = self.KDFExecutor_patcher.start()
+
+        self._encrypt_shards_patcher = mock.patch('failsafe.failsafe._encrypt_shards')
+        self.mock_encrypt_shards = self._encrypt_shards_patcher.start()
+
         self.wallet = mock.MagicMock(Wallet)
-        self.wallet.serialize_b58.return_value = 'b58_serialized_wallet'
+        self.mock_master_key_material.return_value = 'master_key_material'
+        self.wallet.fingerprint = '0x30495462'
 
         self.mock_Wallet.new_random_wallet.return_value = self.wallet
 
         self.shares = ['shard1', 'shard2', 'shard3']
-        self.mock_BitcoinToB58SecretSharer.split_secret.return_value = self.shares
+        self.mock_GF256SecretSharer.split_secret.return_value = self.shares
 
     def tearDown(self):
         self._print_patcher.stop()
         self._get_input_patcher.stop()
         self.Wallet_patcher.stop()
-        self.BitcoinToB58SecretSharer_patcher.stop()
+        self.master_key_material_patcher.stop()
+        self.GF256SecretSharer_patcher.stop()
         self._validate_generate_values_patcher.stop()
         self._generateKeys_patcher.stop()
+        self.BundlePool_patcher.stop()
+        self.BundlePrefetcher_patcher.stop()
+        self._present_bundle_patcher.stop()
+        self.KDFExecutor_patcher.stop()
+        self._encrypt_shards_patcher.stop()
 
     def test_interactive_inputs(self):
         self.mock_get_input.side_effect = [3, 2, 10, 'asdf', '', '', '']
@@ -104,10 +180,10 @@ class TestGenerate(unittest.TestCase):
         self.mock_validate_generate_values.assert_called_once_with(3, 10, 2, 'asdf')
 
         self.mock_Wallet.new_random_wallet.assert_called_once_with('asdf')
-        self.wallet.serialize_b58.assert_called_once_with()
-        self.mock_BitcoinToB58SecretSharer.split_secret.assert_called_once_with('b58_serialized_wallet',
-                                                                                2,
-                                                                                3)
+        self.mock_master_key_material.assert_called_once_with(self.wallet)
+        self.mock_GF256SecretSharer.split_secret.assert_called_once_with('master_key_material',
+                                                                         2,
+                                                                         3)
 
         self.mock_print.assert_has_calls(
                 [mock.call(term.clear),
@@ -130,11 +206,14 @@ class TestGenerate(unittest.TestCase):
 
         self.mock_generateKeys.assert_has_calls(
                 [mock.call(self.wallet, 0, 10, extra_data={'child': '1 of 3',
-                                                           'master_shard': '2-shard1'}),
+                                                           'master_shard': '2-30495462-shard1'},
+                           options=BundleOptions()),
                  mock.call(self.wallet, 1, 10, extra_data={'child': '2 of 3',
-                                                           'master_shard': '2-shard2'}),
+                                                           'master_shard': '2-30495462-shard2'},
+                           options=BundleOptions()),
                  mock.call(self.wallet, 2, 10, extra_data={'child': '3 of 3',
-                                                           'master_shard': '2-shard3'}),
+                                                           'master_shard': '2-30495462-shard3'},
+                           options=BundleOptions()),
                  ])
 
     def test_single_user(self):
@@ -153,8 +232,8 @@ class TestGenerate(unittest.TestCase):
         self.mock_validate_generate_values.assert_called_once_with(1, 5, 1, 'asdf')
 
         self.mock_Wallet.new_random_wallet.assert_called_once_with('asdf')
-        self.wallet.serialize_b58.assert_called_once_with()
-        self.assertFalse(self.mock_BitcoinToB58SecretSharer.called)
+        self.assertFalse(self.mock_master_key_material.called)
+        self.assertFalse(self.mock_GF256SecretSharer.called)
 
         self.mock_print.assert_has_calls(
                 [mock.call(term.clear),
@@ -168,8 +247,109 @@ class TestGenerate(unittest.TestCase):
               ])
 
         self.mock_generateKeys.assert_has_calls(
-                [mock.call(self.wallet, 0, 5, extra_data={}),
+                [mock.call(self.wallet, 0, 5, extra_data={}, options=BundleOptions()),
                  ])
+        self.assertFalse(self.mock_BundlePool.called)
+        self.assertFalse(self.mock_BundlePrefetcher.called)
+
+    def test_shards_encrypted_up_front(self):
+        self.mock_get_input.side_effect = ['', '', '']
+
+        generate(number_of_users=3,
+                 number_of_accounts=10,
+                 key_threshold=2,
+                 extra_entropy='asdf')
+
+        self.mock_KDFExecutor.assert_called_once_with(processes=mock.ANY)
+        kdf_executor = self.mock_KDFExecutor.return_value.__enter__.return_value
+        self.mock_encrypt_shards.assert_called_once_with([{'child': '1 of 3', 'master_shard': '2-30495462-shard1'},
+                                                          {'child': '2 of 3', 'master_shard': '2-30495462-shard2'},
+                                                          {'child': '3 of 3', 'master_shard': '2-30495462-shard3'},
+                                                          ],
+                                                         kdf_executor,
+                                                         100000)
+
+    def test_single_user_has_no_shard_to_encrypt(self):
+        self.mock_get_input.side_effect = ['']
+
+        generate(number_of_users=1,
+                 number_of_accounts=10,
+                 extra_entropy='asdf')
+
+        self.assertFalse(self.mock_KDFExecutor.called)
+        self.assertFalse(self.mock_encrypt_shards.called)
+
+    def test_parallel(self):
+        bundle_pool = self.mock_BundlePool.return_value
+        bundle_pool.next.side_effect = ['bundle1', 'bundle2', 'bundle3']
+
+        expected = None
+        actual = generate(number_of_users=3,
+                          number_of_accounts=10,
+                          key_threshold=2,
+                          extra_entropy='asdf',
+                          parallel=True)
+
+        self.assertEqual(expected, actual)
+        self.mock_BundlePool.assert_called_once_with(self.wallet,
+                                                     10,
+                                                     [{'child': '1 of 3', 'master_shard': '2-30495462-shard1'},
+                                                      {'child': '2 of 3', 'master_shard': '2-30495462-shard2'},
+                                                      {'child': '3 of 3', 'master_shard': '2-30495462-shard3'},
+                                                      ],
+                                                     BundleOptions())
+        self.mock_present_bundle.assert_has_calls([mock.call('bundle1'),
+                                                   mock.call('bundle2'),
+                                                   mock.call('bundle3'),
+                                                   ])
+        bundle_pool.close.assert_called_once_with()
+        self.assertFalse(self.mock_generateKeys.called)
+
+    def test_prefetch(self):
+        bundle_prefetcher = self.mock_BundlePrefetcher.return_value
+        bundle_prefetcher.next.side_effect = ['bundle1', 'bundle2', 'bundle3']
+        self.mock_get_input.side_effect = ['', '', '']
+
+        generate(number_of_users=3,
+                 number_of_accounts=10,
+                 key_threshold=2,
+                 extra_entropy='asdf',
+                 prefetch=True,
+                 options=BundleOptions(lazy_qr=True))
+
+        self.mock_BundlePrefetcher.assert_called_once_with(self.wallet,
+                                                           10,
+                                                           [{'child': '1 of 3', 'master_shard': '2-30495462-shard1'},
+                                                            {'child': '2 of 3', 'master_shard': '2-30495462-shard2'},
+                                                            {'child': '3 of 3', 'master_shard': '2-30495462-shard3'},
+                                                            ],
+                                                           BundleOptions(lazy_qr=True))
+        self.mock_get_input.assert_has_calls([mock.call('Press enter to continue when ready'),
+                                              mock.call('Press enter to continue when ready'),
+                                              mock.call('Press enter to continue when ready'),
+                                              ])
+        self.mock_present_bundle.assert_has_calls([mock.call('bundle1'),
+                                                   mock.call('bundle2'),
+                                                   mock.call('bundle3'),
+                                                   ])
+        bundle_prefetcher.close.assert_called_once_with()
+        self.assertFalse(self.mock_BundlePool.called)
+        self.assertFalse(self.mock_generateKeys.called)
+
+    def test_parallel_aborted(self):
+        bundle_pool = self.mock_BundlePool.return_value
+        self.mock_get_input.side_effect = ['', KeyboardInterrupt]
+
+        self.assertRaises(KeyboardInterrupt,
+                          generate,
+                          number_of_users=3,
+                          number_of_accounts=10,
+                          key_threshold=2,
+                          extra_entropy='asdf',
+                          parallel=True)
+
+        self.assertEqual(1, self.mock_present_bundle.call_count)
+        bundle_pool.close.assert_called_once_with()
 
 class TestRecover(unittest.TestCase):
     def setUp(self):
@@ -179,8 +359,11 @@ class TestRecover(unittest.TestCase):
         self._get_input_patcher = mock.patch('failsafe.failsafe._get_input')
         self.mock_get_input = self._get_input_patcher.start()
 
-        self.decrypt_shard_patcher = mock.patch('failsafe.failsafe.decrypt_shard')
-        self.mock_decrypt_shard = self.decrypt_shard_patcher.start()
+        self._read_shard_patcher = mock.patch('failsafe.failsafe._read_shard')
+        self.mock_read_shard = self._read_shard_patcher.start()
+
+        self.KDFExecutor_patcher = mock.patch('failsafe.failsafe.KDFExecutor')
+        self.mock_KDFExecutor = self.KDFExecutor_patcher.start()
 
         self.Wallet_patcher = mock.patch('failsafe.failsafe.Wallet')
         self.mock_Wallet = self.Wallet_patcher.start()
@@ -191,23 +374,44 @@ class TestRecover(unittest.TestCase):
         self._generateKeys_patcher = mock.patch('failsafe.failsafe._generateKeys')
         self.mock_generateKeys = self._generateKeys_patcher.start()
 
+        self._encrypt_shards_patcher = mock.patch('failsafe.failsafe._encrypt_shards')
+        self.mock_encrypt_shards = self._encrypt_shards_patcher.start()
+
         self.mock_BitcoinToB58SecretSharer.recover_secret.return_value = 'master_key'
         self.mock_BitcoinToB58SecretSharer.recover_share.return_value = 'user_share'
 
-        self.mock_decrypt_shard.side_effect = ['2-shard1', '2-shard2']
+        self.decryptions = self.shard_decryptions('2-shard1', '2-shard2')
         self.wallet = mock.MagicMock(Wallet)
         self.mock_Wallet.deserialize.return_value = self.wallet
+        self.kdf_executor = self.mock_KDFExecutor.return_value.__enter__.return_value
+        self.options = BundleOptions()
 
     def tearDown(self):
         self._print_patcher.stop()
         self._get_input_patcher.stop()
-        self.decrypt_shard_patcher.stop()
+        self._read_shard_patcher.stop()
+        self.KDFExecutor_patcher.stop()
         self.Wallet_patcher.stop()
         self.BitcoinToB58SecretSharer_patcher.stop()
         self._generateKeys_patcher.stop()
+        self._encrypt_shards_patcher.stop()
+
+    def shard_decryptions(self, *results):
+        decryptions = []
+        for result in results:
+            decryption = mock.MagicMock(ShardDecryption)
+            decryption.iterations = ITERATIONS
+            decryption.passphrase_verified.return_value = False
+            if isinstance(result, list):
+                decryption.result.side_effect = result
+            else:
+                decryption.result.return_value = result
+            decryptions.append(decryption)
+        self.mock_read_shard.side_effect = decryptions
+        return decryptions
 
     def test_(self):
-        self.mock_get_input.side_effect = [3,
+        self.mock_get_input.side_effect = ['3',
                                            5,
                                            '',
                                            '',
@@ -221,7 +425,7 @@ class TestRecover(unittest.TestCase):
 
         self.assertEqual(expected, actual)
         self.mock_get_input.assert_has_calls([
-            mock.call("Enter the index of the user who's key should be regenerated: ", input_type=int),
+            mock.call('Enter the indexes of the users whose keys should be regenerated, separated by commas: '),
             mock.call('Enter number of accounts to be created per user [1]: ', input_type=int, default=1),
             mock.call('Press enter to continue'),
             mock.call('Press enter to continue'),
@@ -239,7 +443,7 @@ class TestRecover(unittest.TestCase):
             mock.call('Key progress: 0'),
             mock.call(),
             mock.call(),
-            mock.call('Shard has been accepted', formatters=term.blue),
+            mock.call('Shard has been received and is being checked in the background', formatters=term.blue),
             mock.call(term.clear),
             mock.call('The next screen is for the next user.'),
             mock.call(term.clear),
@@ -247,7 +451,7 @@ class TestRecover(unittest.TestCase):
             mock.call('Key progress: 1'),
             mock.call(),
             mock.call(),
-            mock.call('Shard has been accepted', formatters=term.blue),
+            mock.call('Shard has been received and is being checked in the background', formatters=term.blue),
             mock.call('The next screen is meant for user 3', formatters=term.clear),
             ])
 
@@ -258,49 +462,506 @@ class TestRecover(unittest.TestCase):
                                                        2,
                                                        5,
                                                        extra_data={'master_shard': '2-user_share',
-                                                                   'child': 'user 3'})
-        self.mock_decrypt_shard.assert_has_calls([mock.call(), mock.call()])
+                                                                   'child': 'user 3'},
+                                                       options=self.options)
+        self.mock_read_shard.assert_has_calls([mock.call(kdf_executor=self.kdf_executor),
+                                               mock.call(kdf_executor=self.kdf_executor),
+                                               ])
+
+    def test_several_users(self):
+        self.mock_get_input.side_effect = ['3, 1,3', 5, '', '', '', '', '', '']
+        self.mock_BitcoinToB58SecretSharer.recover_share.side_effect = ['share3', 'share1']
 
+        recover()
+
+        self.assertEqual(2, self.mock_read_shard.call_count)
+        self.mock_BitcoinToB58SecretSharer.recover_secret.assert_called_once_with(['shard1', 'shard2'])
+        self.mock_Wallet.deserialize.assert_called_once_with('master_key')
+        self.mock_BitcoinToB58SecretSharer.recover_share.assert_has_calls([mock.call(['shard1', 'shard2'], 3),
+                                                                           mock.call(['shard1', 'shard2'], 1),
+                                                                           ])
+        self.mock_encrypt_shards.assert_called_once_with([{'master_shard': '2-share3', 'child': 'user 3'},
+                                                          {'master_shard': '2-share1', 'child': 'user 1'},
+                                                          ],
+                                                         self.kdf_executor,
+                                                         ITERATIONS)
+        self.mock_generateKeys.assert_has_calls([
+            mock.call(self.wallet, 2, 5, extra_data={'master_shard': '2-share3', 'child': 'user 3'}, options=self.options),
+            mock.call(self.wallet, 0, 5, extra_data={'master_shard': '2-share1', 'child': 'user 1'}, options=self.options),
+            ])
+        self.mock_print.assert_has_calls([
+            mock.call('Attempting to recover keys for users 3, 1'),
+            mock.call('The next screen is meant for user 3', formatters=term.clear),
+            mock.call('The next screen is meant for user 1', formatters=term.clear),
+            ], any_order=True)
 
-    def test_thresholds_do_not_match(self):
-        self.mock_get_input.side_effect = [3,
+    def test_users_given(self):
+        self.mock_get_input.side_effect = [5, '', '', '', '', '']
+
+        recover(users=[3])
+
+        self.mock_generateKeys.assert_called_once_with(self.wallet,
+                                                       2,
+                                                       5,
+                                                       extra_data={'master_shard': '2-user_share',
+                                                                   'child': 'user 3'},
+                                                       options=self.options)
+
+    def test_invalid_users(self):
+        for users in ['', 'one', '0', '2, -1', '3, 256']:
+            self.mock_get_input.side_effect = [users]
+            self.assertRaises(ValueError, recover)
+        self.assertRaises(ValueError, recover, users=[300])
+        self.assertFalse(self.mock_read_shard.called)
+
+    def test_first_shard_resolved_after_second_is_entered(self):
+        events = []
+        decryptions = iter(self.decryptions)
+
+        def read_shard(kdf_executor=None):
+            events.append('enter')
+            return next(decryptions)
+        self.mock_read_shard.side_effect = read_shard
+        self.decryptions[0].result.side_effect = lambda: events.append('resolve 1') or '2-shard1'
+        self.decryptions[1].result.side_effect = lambda: events.append('resolve 2') or '2-shard2'
+        self.mock_get_input.side_effect = ['3', 5, '', '', '', '', '']
+
+        recover()
+
+        self.assertEqual(['enter', 'enter', 'resolve 1', 'resolve 2'], events)
+
+    def test_threshold_of_three(self):
+        self.shard_decryptions('3-shard1', '3-shard2', '3-shard3')
+        self.mock_get_input.side_effect = ['3', 5, '', '', '', '', '', '', '']
+
+        recover()
+
+        self.assertEqual(3, self.mock_read_shard.call_count)
+        self.mock_BitcoinToB58SecretSharer.recover_secret.assert_called_once_with(['shard1', 'shard2', 'shard3'])
+        self.mock_generateKeys.assert_called_once_with(self.wallet,
+                                                       2,
+                                                       5,
+                                                       extra_data={'master_shard': '3-user_share',
+                                                                   'child': 'user 3'},
+                                                       options=self.options)
+
+    def test_failed_shard_returns_to_its_participant(self):
+        decryptions = self.shard_decryptions([InvalidToken(), '2-shard1'], '2-shard2')
+        self.mock_get_input.side_effect = ['3', 5, '', '', '', '', '', '', '']
+
+        recover()
+
+        decryptions[0].retry.assert_called_once_with()
+        self.assertFalse(decryptions[0].search.called)
+        self.assertFalse(decryptions[1].retry.called)
+        self.mock_print.assert_has_calls([
+            mock.call(term.clear),
+            mock.call('Failed to decrypt the shard entered by participant 1.', formatters=term.red),
+            mock.call('The next screen is for participant 1'),
+            mock.call(term.clear),
+            mock.call('Participant 1, enter your passphrase again'),
+            mock.call(),
+            ])
+        self.mock_BitcoinToB58SecretSharer.recover_secret.assert_called_once_with(['shard1', 'shard2'])
+
+    def test_failed_shard_search(self):
+        decryptions = self.shard_decryptions([InvalidToken()], '2-shard2')
+        decryptions[0].search.return_value = '2-shard1'
+        self.mock_get_input.side_effect = ['3', 5, '', '', '', '', '', 'search', '']
+
+        recover()
+
+        decryptions[0].search.assert_called_once_with(self.mock_KDFExecutor.return_value.__enter__.return_value)
+        self.assertFalse(decryptions[0].retry.called)
+        self.mock_BitcoinToB58SecretSharer.recover_secret.assert_called_once_with(['shard1', 'shard2'])
+
+    def test_mismatched_shard_is_entered_again(self):
+        self.mock_get_input.side_effect = ['3',
                                            5,
                                            '',
                                            '',
                                            '',
                                            '',
+                                           '',
+                                           '',
+                                           '',
                                            ]
-        self.mock_decrypt_shard.side_effect = ['2-shard1', '3-shard2']
+        self.shard_decryptions('2-shard1', '3-shard2', '2-shard3')
 
-        self.assertRaises(ValueError,
-                          recover)
-
-        self.mock_get_input.assert_has_calls([
-            mock.call("Enter the index of the user who's key should be regenerated: ", input_type=int),
-            mock.call('Enter number of accounts to be created per user [1]: ', input_type=int, default=1),
-            mock.call('Press enter to continue'),
-            mock.call('Press enter to continue'),
-            ])
+        recover()
 
+        self.assertEqual(3, self.mock_read_shard.call_count)
         self.mock_print.assert_has_calls([
             mock.call(term.clear),
+            mock.call('The shard entered by participant 2 was rejected. '
+                      'Shard thresholds do not match. An invalid shard has been provided.', formatters=term.red),
+            mock.call('Either this shard or the shards entered before it came from another key generation.'),
+            mock.call('The next screen is for participant 2'),
             mock.call(term.clear),
-            mock.call('Starting on the next screen, each user will be asked to input their piece of the master key.'),
-            mock.call(term.clear),
-            mock.call('Attempting to recover keys for user 3'),
-            mock.call('Key progress: 0'),
-            mock.call(),
-            mock.call(),
-            mock.call('Shard has been accepted', formatters=term.blue),
-            mock.call(term.clear),
-            mock.call('The next screen is for the next user.'),
-            mock.call(term.clear),
-            mock.call('Attempting to recover keys for user 3'),
-            mock.call('Key progress: 1'),
+            mock.call('Participant 2, enter your shard again'),
             mock.call(),
             ])
+        self.mock_BitcoinToB58SecretSharer.recover_secret.assert_called_once_with(['shard1', 'shard3'])
+
+    def test_kdf_iterations_of_entered_shards(self):
+        decryptions = self.shard_decryptions('2-shard1', '2-shard2')
+        decryptions[1].iterations = 250000
+        self.mock_get_input.side_effect = ['3, 1', 5, '', '', '', '', '', '']
+
+        recover()
+
+        self.assertEqual(2, self.mock_generateKeys.call_count)
+        self.assertEqual(250000, self.mock_encrypt_shards.call_args[0][2])
+        for call in self.mock_generateKeys.call_args_list:
+            self.assertEqual(BundleOptions(kdf_iterations=250000), call[1]['options'])
+
+    def test_mismatched_shard_is_set_aside(self):
+        self.mock_get_input.side_effect = ['3', 5, '', '', '', '', 'skip', '', '', '', '']
+        self.shard_decryptions('2-shard1', '3-shard2', '2-shard3')
+
+        recover()
+
+        self.assertEqual(3, self.mock_read_shard.call_count)
+        self.mock_print.assert_any_call('The shard entered by participant 2 has been set aside. Another user will be asked for theirs.')
+        self.mock_BitcoinToB58SecretSharer.recover_secret.assert_called_once_with(['shard1', 'shard3'])
+
+    def test_first_shard_from_another_key_generation(self):
+        self.mock_get_input.side_effect = ['3', 5, '', '', '', '', 'replace', '', '', '', '']
+        self.shard_decryptions('2-0badf00d-1:c2hhcmQx', '2-30495462-2:c2hhcmQy', '2-30495462-3:c2hhcmQz')
+        self.wallet.fingerprint = '0x30495462'
+
+        with mock.patch('failsafe.failsafe.RecoveryContext') as mock_RecoveryContext:
+            mock_RecoveryContext.return_value.share.return_value = '3:dXNlcg'
+            recover()
+
+        self.assertEqual(3, self.mock_read_shard.call_count)
+        mock_RecoveryContext.assert_called_once_with(['2:c2hhcmQy', '3:c2hhcmQz'])
+        self.mock_print.assert_any_call('The shards entered before participant 2 have been set aside. Other users will be asked for theirs.')
+        self.mock_generateKeys.assert_called_once_with(self.wallet,
+                                                       2,
+                                                       5,
+                                                       extra_data={'master_shard': '2-30495462-3:dXNlcg',
+                                                                   'child': 'user 3'},
+                                                       options=self.options)
+
+    def test_fingerprints(self):
+        self.mock_get_input.side_effect = ['3', 5, '', '', '', '', '', '', '']
+        self.shard_decryptions('2-30495462-1:c2hhcmQx', '2-0badf00d-2:c2hhcmQy', '2-30495462-3:c2hhcmQz')
+        self.wallet.fingerprint = '0x30495462'
+
+        with mock.patch('failsafe.failsafe.RecoveryContext') as mock_RecoveryContext:
+            mock_RecoveryContext.return_value.share.return_value = '3:dXNlcg'
+            recover()
+
+        mock_RecoveryContext.assert_called_once_with(['1:c2hhcmQx', '3:c2hhcmQz'])
+        self.mock_print.assert_any_call('The shard entered by participant 2 was rejected. '
+                                        'The shard belongs to a different master key than the shards entered before it.',
+                                        formatters=term.red)
+        self.mock_generateKeys.assert_called_once_with(self.wallet,
+                                                       2,
+                                                       5,
+                                                       extra_data={'master_shard': '2-30495462-3:dXNlcg',
+                                                                   'child': 'user 3'},
+                                                       options=self.options)
+
+    def test_key_material_secret(self):
+        self.mock_get_input.side_effect = ['3', 5, '', '', '', '', '']
+        self.shard_decryptions('2-1:c2hhcmQx', '2-2:c2hhcmQy')
+        master_wallet = Wallet.from_master_secret('failsafe test seed')
+
+        with mock.patch('failsafe.failsafe.RecoveryContext') as mock_RecoveryContext:
+            mock_RecoveryContext.return_value.secret.return_value = master_key_material(master_wallet)
+            mock_RecoveryContext.return_value.share.return_value = '3:dXNlcg'
+            recover()
 
-        self.assertFalse(self.mock_BitcoinToB58SecretSharer.recover_secret.called)
         self.assertFalse(self.mock_Wallet.deserialize.called)
+        recovered_wallet = self.mock_generateKeys.call_args[0][0]
+        self.assertEqual(master_wallet.serialize_b58(), recovered_wallet.serialize_b58())
+
+    def test_recovered_master_does_not_match_fingerprint(self):
+        self.mock_get_input.side_effect = ['3', 5, '', '', '', '']
+        self.shard_decryptions('2-30495462-1:c2hhcmQx', '2-30495462-2:c2hhcmQy')
+        self.wallet.fingerprint = '0x0badf00d'
+
+        with mock.patch('failsafe.failsafe.RecoveryContext'):
+            self.assertRaises(ValueError, recover)
+        self.assertFalse(self.mock_generateKeys.called)
+
+    def test_gf256_shards(self):
+        self.mock_get_input.side_effect = ['3',
+                                           5,
+                                           '',
+                                           '',
+                                           '',
+                                           '',
+                                           '',
+                                           ]
+        self.shard_decryptions('2-1:c2hhcmQx', '2-2:c2hhcmQy')
+
+        with mock.patch('failsafe.failsafe.RecoveryContext') as mock_RecoveryContext:
+            recovery = mock_RecoveryContext.return_value
+            recovery.secret.return_value = 'master_key'
+            recovery.share.return_value = '3:dXNlcg'
+            recover()
+
+        mock_RecoveryContext.assert_called_once_with(['1:c2hhcmQx', '2:c2hhcmQy'])
+        recovery.secret.assert_called_once_with()
+        recovery.share.assert_called_once_with(3)
+        self.assertFalse(self.mock_BitcoinToB58SecretSharer.recover_secret.called)
+        self.mock_generateKeys.assert_called_once_with(self.wallet,
+                                                       2,
+                                                       5,
+                                                       extra_data={'master_shard': '2-3:dXNlcg',
+                                                                   'child': 'user 3'},
+                                                       options=self.options)
+
+    def test_mixed_shard_generations(self):
+        self.mock_get_input.side_effect = ['3',
+                                           5,
+                                           '',
+                                           '',
+                                           '',
+                                           '',
+                                           '',
+                                           ]
+        self.shard_decryptions('2-1:c2hhcmQx', '2-shard2')
+
+        self.assertRaises(ValueError,
+                          recover)
+
+        self.assertFalse(self.mock_BitcoinToB58SecretSharer.recover_secret.called)
         self.assertFalse(self.mock_generateKeys.called)
-        self.mock_decrypt_shard.assert_has_calls([mock.call(), mock.call()])
+
+class TestShardSet(unittest.TestCase):
+    def setUp(self):
+        self.shard_set = ShardSet()
+
+    def test_legacy_shards(self):
+        self.shard_set.add('2-1-hvXUd2Ri8GtQ2X3kUQ')
+        self.shard_set.add('2-3-37jen9EyQLoXVH199La')
+
+        self.assertEqual(2, self.shard_set.threshold)
+        self.assertIsNone(self.shard_set.fingerprint)
+        self.assertEqual(['1-hvXUd2Ri8GtQ2X3kUQ', '3-37jen9EyQLoXVH199La'], self.shard_set.shards)
+
+    def test_fingerprinted_shards(self):
+        self.shard_set.add('3-30495462-1:c2hh-cmQx')
+
+        self.assertEqual(3, self.shard_set.threshold)
+        self.assertEqual('30495462', self.shard_set.fingerprint)
+        self.assertEqual(['1:c2hh-cmQx'], self.shard_set.shards)
+
+    def test_rejected_shards(self):
+        self.shard_set.add('2-30495462-1:c2hhcmQx')
+
+        self.assertRaises(ValueError, self.shard_set.add, '3-30495462-2:c2hhcmQy')
+        self.assertRaises(ValueError, self.shard_set.add, '2-0badf00d-2:c2hhcmQy')
+        self.assertRaises(ValueError, self.shard_set.add, '2-2:c2hhcmQy')
+        self.assertRaises(ValueError, self.shard_set.add, '2-30495462-1:c2hhcmQx')
+        self.assertRaises(ValueError, self.shard_set.add, 'garbage')
+        self.assertEqual(['1:c2hhcmQx'], self.shard_set.shards)
+
+    def test_mismatches(self):
+        self.shard_set.add('2-30495462-1:c2hhcmQx')
+
+        self.assertRaises(ShardMismatchError, self.shard_set.add, '3-30495462-2:c2hhcmQy')
+        self.assertRaises(ShardMismatchError, self.shard_set.add, '2-0badf00d-2:c2hhcmQy')
+        with self.assertRaises(ValueError) as context:
+            self.shard_set.add('2-30495462-1:c2hhcmQx')
+        self.assertNotIsInstance(context.exception, ShardMismatchError)
+
+    def test_replace(self):
+        self.shard_set.add('2-0badf00d-1:c2hhcmQx', 250000)
+        self.shard_set.replace('3-30495462-2:c2hhcmQy')
+
+        self.assertEqual(3, self.shard_set.threshold)
+        self.assertEqual('30495462', self.shard_set.fingerprint)
+        self.assertEqual(['2:c2hhcmQy'], self.shard_set.shards)
+        self.assertEqual(ITERATIONS, self.shard_set.kdf_iterations)
+
+    def test_threshold_of_one(self):
+        self.assertRaises(ValueError, self.shard_set.add, '1-30495462-1:c2hhcmQx')
+        self.assertIsNone(self.shard_set.threshold)
+
+    def test_verify(self):
+        wallet = Wallet.from_master_secret('failsafe test seed')
+        self.shard_set.add('2-{}-1:c2hhcmQx'.format(wallet.fingerprint[2:]))
+        self.shard_set.verify(wallet)
+
+        self.assertRaises(ValueError, self.shard_set.verify, Wallet.from_master_secret('another seed'))
+
+class TestDecryptShard(unittest.TestCase):
+    def setUp(self):
+        self._print_patcher = mock.patch('failsafe.failsafe._print')
+        self.mock_print = self._print_patcher.start()
+
+        self._get_input_patcher = mock.patch('failsafe.failsafe._get_input')
+        self.mock_get_input = self._get_input_patcher.start()
+
+        self.salt = b'salt' * 8
+        self.passphrase = 'throw theory tunnel soda steel mix across surface'
+        # A shard as written before the envelope existed
+        token = Fernet(derive_key(self.passphrase, self.salt, 100000)).encrypt('2-shard1')
+        self.encrypted_shard = '{}${}'.format(base64.urlsafe_b64encode(self.salt),
+                                              base64.urlsafe_b64encode(token))
+
+    def tearDown(self):
+        self._print_patcher.stop()
+        self._get_input_patcher.stop()
+
+    def test_decrypt(self):
+        self.mock_get_input.side_effect = [self.encrypted_shard] + self.passphrase.split()
+
+        self.assertEqual('2-shard1', decrypt_shard())
+
+    def test_unreadable_shard_is_asked_again(self):
+        self.mock_get_input.side_effect = ['not a shard', self.encrypted_shard] + self.passphrase.split()
+
+        self.assertEqual('2-shard1', decrypt_shard())
+        self.mock_print.assert_any_call('Unrecognized encrypted shard format. Enter the encrypted shard again.',
+                                        formatters=term.red)
+
+    def test_shard_entered_again(self):
+        passphrase = new_passphrase(b'\0' * 10)
+        token = encrypt_token('2-shard1', derive_key(passphrase, self.salt, 1000))
+        encrypted_shard = encode_compact_envelope(self.salt, token, 1000)
+        other_shard = encode_compact_envelope(self.salt, encrypt_token('2-shard2', derive_key('other', self.salt, 1000)), 1000)
+        self.mock_get_input.side_effect = ([other_shard] + passphrase.split() +
+                                           ['shard', encrypted_shard] + passphrase.split())
+
+        self.assertEqual('2-shard1', decrypt_shard())
+        self.mock_print.assert_any_call('The passphrase matches its checksum, so the encrypted shard may have been entered wrong.')
+
+    def test_prefixes_are_completed(self):
+        self.mock_get_input.side_effect = [self.encrypted_shard] + [word[:4] for word in self.passphrase.split()]
+
+        self.assertEqual('2-shard1', decrypt_shard())
+
+    def test_unknown_and_ambiguous_words_are_asked_again(self):
+        words = self.passphrase.split()
+        self.mock_get_input.side_effect = [self.encrypted_shard] + words[:2] + ['tunnle', 'tu'] + words[2:]
+
+        self.assertEqual('2-shard1', decrypt_shard())
+        self.mock_print.assert_has_calls([
+            mock.call('Word #3 is not in the word list. Try again.', formatters=term.red),
+            mock.call('Word #3 matches more than one word. Type more of it.', formatters=term.red),
+            ])
+        self.mock_get_input.assert_has_calls([mock.call('Enter word #3: ', secure=True)] * 3)
+
+    def test_retry(self):
+        self.mock_get_input.side_effect = [self.encrypted_shard] + ['wrong', '', ''] + self.passphrase.split()
+
+        self.assertEqual('2-shard1', decrypt_shard())
+        self.mock_print.assert_any_call('Failed to decrypt shard. Try Again.', formatters=term.red)
+
+    def test_search(self):
+        typed = 'throw theory tunnel soda steel across mix surface'
+        self.mock_get_input.side_effect = [self.encrypted_shard] + typed.split() + ['search']
+
+        self.assertEqual('2-shard1', decrypt_shard())
+
+    def test_checksum_mismatch_skips_kdf(self):
+        passphrase = new_passphrase(b'\0' * 10)
+        token = encrypt_token('2-shard1', derive_key(passphrase, self.salt, 1000))
+        encrypted_shard = encode_compact_envelope(self.salt, token, 1000)
+        mistyped = passphrase.replace('ability', 'able')
+        self.mock_get_input.side_effect = [encrypted_shard] + mistyped.split() + [''] + passphrase.split()
+
+        with mock.patch('failsafe.failsafe.derive_key', wraps=derive_key) as mock_derive_key:
+            self.assertEqual('2-shard1', decrypt_shard())
+
+        mock_derive_key.assert_called_once_with(passphrase, self.salt, 1000)
+        self.mock_print.assert_any_call('The passphrase does not match its checksum, so one of its words is wrong.',
+                                        formatters=term.red)
+        self.assertNotIn(mock.call('Failed to decrypt shard. Try Again.', formatters=term.red),
+                         self.mock_print.call_args_list)
+
+    def test_checksum_mismatch_kept(self):
+        passphrase = new_passphrase(b'\0' * 10)
+        token = encrypt_token('2-shard1', derive_key(passphrase, self.salt, 1000))
+        encrypted_shard = encode_compact_envelope(self.salt, token, 1000)
+        mistyped = passphrase.replace('ability', 'able')
+        self.mock_get_input.side_effect = [encrypted_shard] + mistyped.split() + ['keep', ''] + passphrase.split()
+
+        with mock.patch('failsafe.failsafe.derive_key', wraps=derive_key) as mock_derive_key:
+            self.assertEqual('2-shard1', decrypt_shard())
+
+        mock_derive_key.assert_called_once_with(passphrase, self.salt, 1000)
+        self.mock_print.assert_any_call('Failed to decrypt shard. Try Again.', formatters=term.red)
+
+    def test_kdf_executor(self):
+        self.mock_get_input.side_effect = [self.encrypted_shard] + self.passphrase.split()
+
+        with KDFExecutor(processes=1) as kdf_executor:
+            self.assertEqual('2-shard1', decrypt_shard(kdf_executor=kdf_executor))
+
+class TestBackgroundQRWriter(unittest.TestCase):
+    def setUp(self):
+        self.mock_account_writer = mock.MagicMock()
+
+        self.user_key = Wallet.from_master_secret('failsafe test seed').get_child(0, is_prime=True)
+
+    def test_writes_every_account(self):
+        # Mocks do not record concurrent calls reliably, so keep our own list
+        lock = threading.Lock()
+        written = []
+
+        def write(account):
+            with lock:
+                written.append(account.index)
+        self.mock_account_writer.write.side_effect = write
+
+        qr_writer = BackgroundQRWriter(self.user_key.serialize_b58(), 3, self.mock_account_writer, threads=2)
+        qr_writer.wait()
+
+        self.assertTrue(qr_writer.done())
+        self.assertEqual(3, qr_writer.written)
+        self.assertEqual([0, 1, 2], sorted(written))
+        self.mock_account_writer.close.assert_called_once_with()
+
+    def test_cancel_skips_remaining_accounts(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def write(account):
+            started.set()
+            release.wait()
+        self.mock_account_writer.write.side_effect = write
+
+        qr_writer = BackgroundQRWriter(self.user_key.serialize_b58(), 10, self.mock_account_writer, threads=1)
+        started.wait()
+        release.set()
+        qr_writer.cancel()
+
+        self.assertTrue(qr_writer.done())
+        self.assertLess(qr_writer.written, 10)
+        self.mock_account_writer.close.assert_called_once_with()
+
+class TestEncryptShards(unittest.TestCase):
+    def test_round_trip(self):
+        user_data = [{'child': '1 of 2', 'master_shard': '2-shard1'},
+                     {'child': '2 of 2', 'master_shard': '2-shard2'},
+                     ]
+        with KDFExecutor(processes=2) as kdf_executor:
+            _encrypt_shards(user_data, kdf_executor)
+
+        for data, shard in zip(user_data, ['2-shard1', '2-shard2']):
+            self.assertNotIn('master_shard', data)
+            self.assertEqual(8, len(data['passphrase'].split()))
+
+            envelope = parse_envelope(data['encrypted_shard'])
+            self.assertEqual(100000, envelope.iterations)
+            self.assertTrue(envelope.checksum)
+            self.assertTrue(verify_checksum(data['passphrase']))
+            key = derive_key(data['passphrase'], envelope.salt)
+            self.assertEqual(shard, decrypt_token(envelope, key))
+
+    def test_iterations(self):
+        user_data = [{'child': '1 of 2', 'master_shard': '2-shard1'}]
+        with KDFExecutor(processes=1) as kdf_executor:
+            _encrypt_shards(user_data, kdf_executor, 120000)
+
+        envelope = parse_envelope(user_data[0]['encrypted_shard'])
+        self.assertEqual(120000, envelope.iterations)
+        key = derive_key(user_data[0]['passphrase'], envelope.salt, 120000)
+        self.assertEqual('2-shard1', decrypt_token(envelope, key))
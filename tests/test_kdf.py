@@ -0,0 +1,56 @@
+import base64
+import hashlib
+import unittest
+import mock
+
+from failsafe.kdf import MAX_ITERATIONS, KDFExecutor, calibrate, derive_key
+
+class TestDeriveKey(unittest.TestCase):
+    def test_matches_pbkdf2(self):
+        expected = base64.urlsafe_b64encode(hashlib.pbkdf2_hmac('sha256', b'correct horse', b'salt', 1000, 32))
+        self.assertEqual(expected, derive_key(b'correct horse', b'salt', iterations=1000))
+
+class TestKDFExecutor(unittest.TestCase):
+    def setUp(self):
+        self.kdf_executor = KDFExecutor(processes=2)
+
+    def tearDown(self):
+        self.kdf_executor.close()
+
+    def test_map(self):
+        jobs = [(b'first passphrase', b'salt1', 1000),
+                (b'second passphrase', b'salt2', 1000),
+                (b'third passphrase', b'salt3', 1000),
+                ]
+        self.assertEqual([derive_key(*job) for job in jobs], self.kdf_executor.map(jobs))
+
+    def test_derive(self):
+        self.assertEqual(derive_key(b'passphrase', b'salt', 1000),
+                         self.kdf_executor.derive(b'passphrase', b'salt', 1000))
+
+    def test_submit(self):
+        result = self.kdf_executor.submit(b'passphrase', b'salt', 1000)
+        self.assertEqual(derive_key(b'passphrase', b'salt', 1000), result.get())
+
+class TestCalibrate(unittest.TestCase):
+    @mock.patch('failsafe.kdf.derive_key')
+    @mock.patch('failsafe.kdf.time.time')
+    def test_scales_sample(self, mock_time, mock_derive_key):
+        mock_time.side_effect = [10.0, 10.1]
+
+        self.assertEqual(400000, calibrate(2.0, sample_iterations=20000))
+        mock_derive_key.assert_called_once_with(mock.ANY, mock.ANY, iterations=20000)
+
+    @mock.patch('failsafe.kdf.derive_key')
+    @mock.patch('failsafe.kdf.time.time')
+    def test_minimum(self, mock_time, mock_derive_key):
+        mock_time.side_effect = [10.0, 11.0]
+
+        self.assertEqual(100000, calibrate(0.1, sample_iterations=20000))
+
+    @mock.patch('failsafe.kdf.derive_key')
+    @mock.patch('failsafe.kdf.time.time')
+    def test_maximum(self, mock_time, mock_derive_key):
+        mock_time.side_effect = [10.0, 10.001]
+
+        self.assertEqual(MAX_ITERATIONS, calibrate(60.0, sample_iterations=20000))
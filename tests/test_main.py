@@ -0,0 +1,24 @@
+import unittest
+
+from docopt import docopt
+
+from failsafe import main
+
+class TestUsage(unittest.TestCase):
+    def test_generate_with_profile(self):
+        arguments = docopt(main.__doc__, argv=['-u', '3', '--lazy-qr', '--profile'])
+
+        self.assertTrue(arguments['--profile'])
+        self.assertTrue(arguments['--lazy-qr'])
+        self.assertEqual('3', arguments['USERS'])
+        self.assertFalse(arguments['--recover'])
+
+    def test_profile_alone(self):
+        self.assertTrue(docopt(main.__doc__, argv=['--profile'])['--profile'])
+
+    def test_recover_users(self):
+        arguments = docopt(main.__doc__, argv=['-r', '--recover-users=1,3', '--profile'])
+
+        self.assertTrue(arguments['--recover'])
+        self.assertEqual('1,3', arguments['--recover-users'])
+        self.assertTrue(arguments['--profile'])
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from contextlib import closing
+
+from failsafe.output import (ArchiveOutput,
+                             DirectoryOutput,
+                             MemoryOutput,
+                             )
+
+class OutputTests(object):
+    needs_export = False
+
+    def setUp(self):
+        self.output = self.output_class()
+        self.destination = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.output.destroy()
+        shutil.rmtree(self.destination)
+
+    def test_write_and_read(self):
+        with self.output.open('child1.pub.png') as f:
+            f.write(b'png data')
+        with self.output.open('user_info.priv.json') as f:
+            f.write(b'{}')
+
+        self.assertEqual(['child1.pub.png', 'user_info.priv.json'], self.output.names())
+        self.assertEqual(b'png data', self.output.read('child1.pub.png'))
+
+    def test_export(self):
+        with self.output.open('user_info.priv.json') as f:
+            f.write(b'{}')
+
+        paths = self.output.export(self.destination)
+
+        self.assertEqual([os.path.join(self.destination, 'user_info.priv.json')], paths)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(b'{}', f.read())
+
+    def test_export_does_not_overwrite(self):
+        with self.output.open('child1.pub.png') as f:
+            f.write(b'png data')
+        with self.output.open('user_info.priv.json') as f:
+            f.write(b'{}')
+        existing = os.path.join(self.destination, 'user_info.priv.json')
+        with open(existing, 'wb') as f:
+            f.write(b'another user')
+
+        self.assertRaises(OSError, self.output.export, self.destination)
+        self.assertEqual(['user_info.priv.json'], os.listdir(self.destination))
+        with open(existing, 'rb') as f:
+            self.assertEqual(b'another user', f.read())
+
+    def test_needs_export(self):
+        self.assertEqual(self.needs_export, self.output.needs_export)
+
+class TestDirectoryOutput(OutputTests, unittest.TestCase):
+    output_class = DirectoryOutput
+
+    def test_destroy(self):
+        with self.output.open('user_info.priv.json') as f:
+            f.write(b'{}')
+        self.output.destroy()
+
+        self.assertFalse(os.path.exists(self.output.directory))
+
+class TestMemoryOutput(OutputTests, unittest.TestCase):
+    output_class = MemoryOutput
+    needs_export = True
+
+    def test_nothing_written_to_disk(self):
+        with self.output.open('user_info.priv.json') as f:
+            f.write(b'{}')
+
+        self.assertEqual('user_info.priv.json (in memory)', self.output.describe('user_info.priv.json'))
+        self.assertEqual([], os.listdir(self.destination))
+
+    def test_destroy(self):
+        with self.output.open('user_info.priv.json') as f:
+            f.write(b'{}')
+        self.output.destroy()
+
+        self.assertEqual([], self.output.names())
+
+class ArchiveOutputTests(object):
+    def setUp(self):
+        self.output = ArchiveOutput(self.archive_format)
+        self.destination = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.output.destroy()
+        shutil.rmtree(self.destination)
+
+    def write_bundle(self):
+        with self.output.open('child1.pub.png') as f:
+            f.write(b'png data')
+        with self.output.open('user_info.priv.json') as f:
+            f.write(b'{}')
+        self.output.finish()
+
+    def test_members_and_manifest(self):
+        self.write_bundle()
+
+        self.assertEqual(['failsafe_bundle.{}'.format(self.archive_format)], os.listdir(self.output.directory))
+        self.assertEqual(b'png data', self.output.read('child1.pub.png'))
+        self.assertEqual(('{}  child1.pub.png\n'
+                          '{}  user_info.priv.json\n').format(hashlib.sha256(b'png data').hexdigest(),
+                                                              hashlib.sha256(b'{}').hexdigest()).encode('ascii'),
+                         self.output.read('SHA256SUMS'))
+        self.assertEqual(['SHA256SUMS', 'child1.pub.png', 'user_info.priv.json'], self.member_names())
+
+    def test_export(self):
+        self.write_bundle()
+
+        paths = self.output.export(self.destination)
+        self.assertEqual([os.path.join(self.destination, 'failsafe_bundle.{}'.format(self.archive_format))], paths)
+
+    def test_members_are_spooled_to_disk(self):
+        with self.output.open('user_info.priv.json') as f:
+            f.write(b'{}')
+            spooled = [name for name in os.listdir(self.output.directory) if not name.startswith('failsafe_bundle')]
+            self.assertEqual(1, len(spooled))
+            with open(os.path.join(self.output.directory, spooled[0]), 'rb') as spool:
+                f.flush()
+                self.assertEqual(b'{}', spool.read())
+
+        self.assertEqual(['failsafe_bundle.{}'.format(self.archive_format)], os.listdir(self.output.directory))
+        self.output.finish()
+        self.assertEqual(b'{}', self.output.read('user_info.priv.json'))
+
+    def test_export_does_not_overwrite(self):
+        self.write_bundle()
+        self.output.export(self.destination)
+
+        self.assertRaises(OSError, self.output.export, self.destination)
+
+    def test_needs_export(self):
+        self.assertFalse(self.output.needs_export)
+
+    def test_pickle(self):
+        restored = pickle.loads(pickle.dumps(self.output))
+        with restored.open('user_info.priv.json') as f:
+            f.write(b'{}')
+        restored.finish()
+
+        restored = pickle.loads(pickle.dumps(restored))
+        self.assertEqual(b'{}', restored.read('user_info.priv.json'))
+
+class TestTarOutput(ArchiveOutputTests, unittest.TestCase):
+    archive_format = 'tar'
+
+    def member_names(self):
+        with closing(tarfile.open(self.output.path)) as archive:
+            return sorted(archive.getnames())
+
+class TestZipOutput(ArchiveOutputTests, unittest.TestCase):
+    archive_format = 'zip'
+
+    def member_names(self):
+        with closing(zipfile.ZipFile(self.output.path)) as archive:
+            return sorted(archive.namelist())
@@ -0,0 +1,27 @@
+import unittest
+
+from failsafe.passphrase import WORD_COUNT, new_passphrase, verify_checksum
+from failsafe.words import wordlist
+
+class TestPassphrase(unittest.TestCase):
+    def test_known_entropy(self):
+        self.assertEqual('abandon abandon abandon abandon abandon abandon abandon ability',
+                         new_passphrase(b'\0' * 10))
+        self.assertEqual('zoo zoo zoo zoo zoo zoo zoo theme',
+                         new_passphrase(b'\xff' * 10))
+
+    def test_round_trip(self):
+        for x in range(20):
+            passphrase = new_passphrase()
+
+            self.assertEqual(WORD_COUNT, len(passphrase.split()))
+            self.assertTrue(all(word in wordlist for word in passphrase.split()))
+            self.assertTrue(verify_checksum(passphrase))
+
+    def test_mistyped_word(self):
+        self.assertFalse(verify_checksum('abandon abandon abandon abandon abandon abandon abandon able'))
+        self.assertFalse(verify_checksum('abandon abandon abandon abandon abandon abandon ability abandon'))
+
+    def test_not_checksummed(self):
+        self.assertFalse(verify_checksum('abandon abandon abandon'))
+        self.assertFalse(verify_checksum('abandon abandon abandon abandon abandon abandon abandon xyzzy'))
@@ -0,0 +1,78 @@
+import unittest
+import mock
+
+from failsafe.profiling import NULL_STAGE, Profiler
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.time_patcher = mock.patch('failsafe.profiling.time.time')
+        self.mock_time = self.time_patcher.start()
+        self.mock_time.return_value = 0
+
+        self.profiler = Profiler()
+
+    def tearDown(self):
+        self.time_patcher.stop()
+
+    def test_disabled(self):
+        self.assertIs(NULL_STAGE, self.profiler.stage('qr_make'))
+
+        with self.profiler.stage('qr_make'):
+            pass
+
+        self.assertEqual({}, self.profiler.stages)
+
+    def test_stage(self):
+        self.profiler.enable()
+        self.mock_time.side_effect = [1, 3, 3, 4]
+
+        with self.profiler.stage('qr_make'):
+            pass
+        with self.profiler.stage('qr_make'):
+            pass
+
+        self.assertEqual({'qr_make': {'calls': 2,
+                                      'total_seconds': 3.0,
+                                      'self_seconds': 3.0}},
+                         self.profiler.stages)
+
+    def test_nested_stages(self):
+        self.profiler.enable()
+        self.mock_time.side_effect = [0, 1, 3, 10]
+
+        with self.profiler.stage('json_write'):
+            with self.profiler.stage('qr_make'):
+                pass
+
+        self.assertEqual({'json_write': {'calls': 1,
+                                         'total_seconds': 10.0,
+                                         'self_seconds': 8.0},
+                          'qr_make': {'calls': 1,
+                                      'total_seconds': 2.0,
+                                      'self_seconds': 2.0}},
+                         self.profiler.stages)
+
+    def test_drain_and_merge(self):
+        self.profiler.enable()
+        self.profiler.add('pbkdf2', 2.0)
+        stages = self.profiler.drain()
+
+        self.assertEqual({}, self.profiler.stages)
+
+        self.profiler.add('pbkdf2', 1.0)
+        self.profiler.merge(stages)
+        self.assertEqual({'pbkdf2': {'calls': 2,
+                                     'total_seconds': 3.0,
+                                     'self_seconds': 3.0}},
+                         self.profiler.stages)
+
+    def test_report(self):
+        self.profiler.enable()
+        self.profiler.add('pbkdf2', 2.0)
+        self.mock_time.return_value = 5
+
+        self.assertEqual({'wall_seconds': 5,
+                          'stages': {'pbkdf2': {'calls': 1,
+                                                'total_seconds': 2.0,
+                                                'self_seconds': 2.0}}},
+                         self.profiler.report())
@@ -0,0 +1,115 @@
+import unittest
+
+from io import BytesIO
+
+from qrcode import QRCode, util
+
+from failsafe.output import MemoryOutput
+from failsafe.qr import (ERROR_CORRECTION_LEVELS,
+                         QRRenderer,
+                         write_matrix,
+                         write_pbm,
+                         write_svg,
+                         )
+
+WIFS = ['KxuaP6p1TdjQD1chStoWEhWzvBdzmWQ7z1WJxLC91oVnLRykTVcE',
+        'L1RAY7fkPB46GbnoNhWDk7syv28VPRHFDZnMB3iEuqXLXzW9BuCk',
+        'L2iGP7A4cKHKyTkx7LGyafFHdfR6SqBhMqprGSAqKkZ3qa3x7BiP',
+        ]
+
+class TestQRRenderer(unittest.TestCase):
+    def reference_matrix(self, data, version, mask_pattern, error_correction='M'):
+        code = QRCode(version=version,
+                      mask_pattern=mask_pattern,
+                      error_correction=ERROR_CORRECTION_LEVELS[error_correction],
+                      border=0)
+        code.add_data(data, optimize=0)
+        code.make(fit=False)
+        return code.get_matrix()
+
+    def test_matches_qrcode(self):
+        renderer = QRRenderer()
+        for wif in WIFS:
+            matrix = renderer.modules('wif', wif)
+            version, mask_pattern = renderer._layouts[('wif', len(wif), util.MODE_8BIT_BYTE)]
+            self.assertEqual(self.reference_matrix(wif, version, mask_pattern), matrix)
+
+    def test_layout_is_picked_by_first_payload(self):
+        renderer = QRRenderer()
+        first = QRCode()
+        first.add_data(WIFS[0], optimize=0)
+        version = first.best_fit()
+        mask_pattern = first.best_mask_pattern()
+
+        renderer.modules('wif', WIFS[0])
+        renderer.modules('wif', WIFS[1])
+
+        self.assertEqual({('wif', len(WIFS[0]), util.MODE_8BIT_BYTE): (version, mask_pattern)},
+                         renderer._layouts)
+
+    def test_alphanumeric_payload(self):
+        renderer = QRRenderer()
+        shard = WIFS[0].upper() * 3
+        matrix = renderer.modules('shard', shard)
+        renderer.modules('shard', WIFS[0] * 3)
+
+        version, mask_pattern = renderer._layouts[('shard', len(shard), util.MODE_ALPHA_NUM)]
+        self.assertEqual(self.reference_matrix(shard, version, mask_pattern), matrix)
+        self.assertLess(version, renderer._layouts[('shard', len(shard), util.MODE_8BIT_BYTE)][0])
+
+    def test_error_correction(self):
+        low = QRRenderer('L').encode('shard', WIFS[0] * 3)
+        high = QRRenderer('H').encode('shard', WIFS[0] * 3)
+        self.assertLess(low.version, high.version)
+
+    def test_make(self):
+        renderer = QRRenderer()
+        matrix = renderer.modules('address', '1J6SPoc8BSoanEcst81zxNA6LnaVQiQx47')
+        img = renderer.make('address', '1J6SPoc8BSoanEcst81zxNA6LnaVQiQx47')
+
+        self.assertEqual('1', img.mode)
+        self.assertEqual(((len(matrix) + 8) * 10, (len(matrix) + 8) * 10), img.size)
+        self.assertEqual(255, img.getpixel((5, 5)))
+        for row_index, row in enumerate(matrix):
+            for col_index, module in enumerate(row):
+                self.assertEqual(0 if module else 255, img.getpixel(((col_index + 4) * 10 + 5, (row_index + 4) * 10 + 5)))
+
+    def test_save(self):
+        output = MemoryOutput()
+        QRRenderer().save('address', '1J6SPoc8BSoanEcst81zxNA6LnaVQiQx47', output, 'child1.pub', ('png', 'svg', 'matrix'))
+
+        self.assertEqual(['child1.pub.png', 'child1.pub.svg', 'child1.pub.txt'], output.names())
+        self.assertTrue(output.read('child1.pub.png').startswith(b'\x89PNG'))
+
+class TestWriters(unittest.TestCase):
+    def setUp(self):
+        self.modules = [[True, False],
+                        [False, True],
+                        ]
+
+    def test_matrix(self):
+        fp = BytesIO()
+        write_matrix(self.modules, fp)
+        self.assertEqual(b'10\n01\n', fp.getvalue())
+
+    def test_svg(self):
+        fp = BytesIO()
+        write_svg(self.modules, fp)
+        svg = fp.getvalue()
+
+        self.assertIn(b'width="100" height="100" viewBox="0 0 10 10"', svg)
+        self.assertIn(b'd="M4 4h1v1h-1zM5 5h1v1h-1z"', svg)
+
+    def test_pbm(self):
+        fp = BytesIO()
+        write_pbm(self.modules, fp)
+        magic, size, data = fp.getvalue().split(b'\n', 2)
+
+        self.assertEqual(b'P4', magic)
+        self.assertEqual(b'100 100', size)
+        # 100 pixels pad out to 13 bytes per row
+        self.assertEqual(13 * 100, len(data))
+
+        row = bytearray(data[40 * 13:41 * 13])
+        # Pixels 40-49 are the first dark module
+        self.assertEqual([0, 0, 0, 0, 0, 0xff, 0xc0, 0, 0, 0, 0, 0, 0], list(row))
@@ -0,0 +1,153 @@
+import itertools
+import mock
+import unittest
+
+from secretsharing import BitcoinToB58SecretSharer
+
+from failsafe import shamir
+from failsafe.failsafe import LegacyRecoveryContext, _recovery_context
+from failsafe.shamir import (EXP,
+                             LOG,
+                             GF256SecretSharer,
+                             RecoveryContext,
+                             decode_share,
+                             gf_div,
+                             gf_mul,
+                             )
+
+SECRET = b'xprv9s21ZrQH143K3QTDL4LXw2F7HEK3wJUD2nW2nRk4stbPy6cq3jPPqjiChkVvvNKmPGJxWUtg6LnF5kejMRNNU3TGtRBeJgk33yuGBxrMPHi'
+
+class TestField(unittest.TestCase):
+    def test_tables(self):
+        self.assertEqual(sorted(EXP[:255]), range(1, 256))
+        for value in range(1, 256):
+            self.assertEqual(value, EXP[LOG[value]])
+
+    def test_mul(self):
+        # Worked example from FIPS-197 section 4.2
+        self.assertEqual(0xc1, gf_mul(0x57, 0x83))
+        self.assertEqual(0, gf_mul(0, 0x83))
+
+    def test_div(self):
+        for a, b in [(0x57, 0x83), (1, 0xff), (0, 7)]:
+            self.assertEqual(a, gf_mul(gf_div(a, b), b))
+        self.assertRaises(ZeroDivisionError, gf_div, 1, 0)
+
+class TestGF256SecretSharer(unittest.TestCase):
+    def test_any_threshold_of_shares(self):
+        shares = GF256SecretSharer.split_secret(SECRET, 3, 5)
+
+        self.assertEqual(5, len(shares))
+        for share in shares:
+            self.assertEqual(len(SECRET), len(decode_share(share)[1]))
+        for subset in itertools.combinations(shares, 3):
+            self.assertEqual(SECRET, GF256SecretSharer.recover_secret(list(subset)))
+
+    def test_too_few_shares(self):
+        shares = GF256SecretSharer.split_secret(SECRET, 3, 5)
+        self.assertNotEqual(SECRET, GF256SecretSharer.recover_secret(shares[:2]))
+
+    def test_recover_share(self):
+        shares = GF256SecretSharer.split_secret(SECRET, 2, 4)
+
+        self.assertEqual(shares[3], GF256SecretSharer.recover_share(shares[:2], 4))
+        self.assertEqual(shares[0], GF256SecretSharer.recover_share(shares[:2], 1))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, GF256SecretSharer.split_secret, SECRET, 1, 2)
+        self.assertRaises(ValueError, GF256SecretSharer.split_secret, SECRET, 3, 2)
+        self.assertRaises(ValueError, GF256SecretSharer.split_secret, SECRET, 2, 256)
+
+        shares = GF256SecretSharer.split_secret(SECRET, 2, 3)
+        self.assertRaises(ValueError, GF256SecretSharer.recover_secret, [shares[0], shares[0]])
+        self.assertRaises(ValueError, GF256SecretSharer.recover_share, shares, 0)
+
+class TestRecoveryContext(unittest.TestCase):
+    def setUp(self):
+        self.shares = GF256SecretSharer.split_secret(SECRET, 3, 6)
+        self.context = RecoveryContext(self.shares[1:4])
+
+    def test_secret_and_shares(self):
+        self.assertEqual(SECRET, self.context.secret())
+        for x, share in enumerate(self.shares, 1):
+            self.assertEqual(share, self.context.share(x))
+
+    def test_weights(self):
+        # The weights at any x sum to 1, the value of the constant polynomial
+        for x in [0, 1, 2, 5, 255]:
+            total = 0
+            for weight in self.context.weights(x):
+                total ^= weight
+            self.assertEqual(1, total)
+        self.assertEqual([1, 0, 0], self.context.weights(2))
+
+    def test_basis_computed_once(self):
+        with mock.patch('failsafe.shamir._barycentric_weights', wraps=shamir._barycentric_weights) as mock_weights:
+            context = RecoveryContext(self.shares[:3])
+            context.secret()
+            context.share(4)
+            context.share(5)
+
+        mock_weights.assert_called_once_with([1, 2, 3])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, RecoveryContext, [self.shares[0], self.shares[0]])
+        self.assertRaises(ValueError, self.context.share, 256)
+
+class TestRecoveryContextForShards(unittest.TestCase):
+    def test_gf256(self):
+        shares = GF256SecretSharer.split_secret(SECRET, 2, 3)
+
+        context = _recovery_context(shares[1:])
+        self.assertIsInstance(context, RecoveryContext)
+        self.assertEqual(SECRET, context.secret())
+
+    def test_legacy(self):
+        shares = BitcoinToB58SecretSharer.split_secret(SECRET, 2, 3)
+
+        context = _recovery_context(shares[1:])
+        self.assertIsInstance(context, LegacyRecoveryContext)
+        self.assertEqual(SECRET, context.secret())
+        self.assertEqual(shares[0], context.share(1))
+
+    def test_mixed(self):
+        self.assertRaises(ValueError, _recovery_context, ['1:abcd', '2-efgh'])
+
+@unittest.skipIf(shamir.numpy is None, 'NumPy is not installed')
+class TestNumpy(unittest.TestCase):
+    def setUp(self):
+        # Any bytes will do as coefficients, rotations of the secret keep them fixed
+        self.coefficients = [bytearray(SECRET[k:] + SECRET[:k]) for k in range(5)]
+        self.xs = range(1, 256)
+
+    def test_evaluate(self):
+        self.assertEqual(shamir._evaluate_python(self.coefficients, self.xs),
+                         shamir._evaluate_numpy(self.coefficients, self.xs))
+
+    def test_barycentric_weights(self):
+        for xs in [self.xs, [1, 2], [7, 200, 3]]:
+            self.assertEqual(shamir._barycentric_weights_python(xs),
+                             shamir._barycentric_weights_numpy(xs))
+
+    def test_combine(self):
+        ys = shamir._evaluate_python(self.coefficients, self.xs)
+        weights = shamir._barycentric_weights_python(self.xs)
+        self.assertEqual(shamir._combine_python(weights, shamir._stack_python(ys)),
+                         shamir._combine_numpy(weights, shamir._stack_numpy(ys)))
+
+    def test_python_recovery(self):
+        shares = GF256SecretSharer.split_secret(SECRET, 3, 6)
+        with mock.patch.multiple('failsafe.shamir',
+                                 _barycentric_weights=shamir._barycentric_weights_python,
+                                 _stack=shamir._stack_python,
+                                 _combine=shamir._combine_python):
+            context = RecoveryContext(shares[2:5])
+
+            self.assertEqual(SECRET, context.secret())
+            self.assertEqual(shares[0], context.share(1))
+
+    def test_many_shares(self):
+        shares = GF256SecretSharer.split_secret(SECRET, 200, 255)
+
+        self.assertEqual(SECRET, GF256SecretSharer.recover_secret(shares[55:]))
+        self.assertEqual(shares[0], GF256SecretSharer.recover_share(shares[55:], 1))
@@ -0,0 +1,58 @@
+import unittest
+
+from io import BytesIO
+
+from PIL import Image
+
+from failsafe.derivation import Account
+from failsafe.output import MemoryOutput
+from failsafe.qr import QRRenderer
+from failsafe.sheet import ContactSheet
+
+WIF = 'KxuaP6p1TdjQD1chStoWEhWzvBdzmWQ7z1WJxLC91oVnLRykTVcE'
+ADDRESS = '1J6SPoc8BSoanEcst81zxNA6LnaVQiQx47'
+
+class TestContactSheet(unittest.TestCase):
+    def setUp(self):
+        self.output = MemoryOutput()
+
+    def write_accounts(self, sheet, indexes):
+        for index in indexes:
+            sheet.write(Account(index, WIF, ADDRESS))
+
+    def test_png_pages(self):
+        sheet = ContactSheet(self.output, QRRenderer(), 'png')
+        # Out of order, as the background writer may deliver them
+        self.write_accounts(sheet, reversed(range(sheet.accounts_per_page + 1)))
+
+        # The first page is saved as soon as it is full
+        self.assertEqual(['accounts_page1.png'], self.output.names())
+
+        sheet.close()
+        self.assertEqual(['accounts_page1.png', 'accounts_page2.png'], self.output.names())
+
+        page = Image.open(BytesIO(self.output.read('accounts_page2.png')))
+        self.assertEqual((1240, 1754), page.size)
+
+    def test_pdf(self):
+        sheet = ContactSheet(self.output, QRRenderer(), 'pdf')
+        self.write_accounts(sheet, range(sheet.accounts_per_page * 2 + 1))
+        self.assertEqual([], self.output.names())
+
+        sheet.close()
+        self.assertEqual(['accounts.pdf'], sheet.filenames)
+        pdf = self.output.read('accounts.pdf')
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        self.assertIn(b'/Count 3', pdf)
+
+    def test_writes_after_close_are_ignored(self):
+        sheet = ContactSheet(self.output, QRRenderer(), 'png')
+        self.write_accounts(sheet, [0])
+        sheet.close()
+        self.write_accounts(sheet, [1])
+        sheet.close()
+
+        self.assertEqual(['accounts_page1.png'], self.output.names())
+
+    def test_invalid_format(self):
+        self.assertRaises(ValueError, ContactSheet, self.output, QRRenderer(), 'gif')
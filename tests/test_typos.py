@@ -0,0 +1,80 @@
+import itertools
+import mock
+import unittest
+
+from failsafe.envelope import encode_compact_envelope, encrypt_token, parse_envelope
+from failsafe.kdf import KDFExecutor, derive_key
+from failsafe.typos import (candidates,
+                            edit_distance,
+                            search_passphrase,
+                            word_options,
+                            )
+
+PASSPHRASE = 'throw theory tunnel soda steel mix across surface'
+
+class TestEditDistance(unittest.TestCase):
+    def test_edit_distance(self):
+        self.assertEqual(0, edit_distance('soda', 'soda'))
+        self.assertEqual(1, edit_distance('soda', 'sofa'))
+        self.assertEqual(1, edit_distance('soda', 'sod'))
+        self.assertEqual(2, edit_distance('soda', 'osda'))
+        self.assertEqual(4, edit_distance('', 'soda'))
+
+class TestWordOptions(unittest.TestCase):
+    def test_cheapest_first(self):
+        options = word_options('mix')
+
+        self.assertEqual(sorted(options), options)
+        self.assertIn((2, 'mixed'), options)
+        self.assertNotIn('mix', [word for cost, word in options])
+
+class TestCandidates(unittest.TestCase):
+    def test_substitution(self):
+        words = PASSPHRASE.split()
+        words[3] = 'soap'
+
+        self.assertIn(PASSPHRASE.split(), list(candidates(words)))
+
+    def test_swaps_before_substitutions(self):
+        words = PASSPHRASE.split()
+        words[1], words[2] = words[2], words[1]
+
+        generated = list(itertools.islice(candidates(words), 7))
+        self.assertIn(PASSPHRASE.split(), generated)
+
+    def test_distinct_and_limited(self):
+        generated = [tuple(candidate) for candidate in candidates(PASSPHRASE.split(), limit=20)]
+
+        self.assertEqual(20, len(generated))
+        self.assertEqual(len(generated), len(set(generated)))
+        self.assertNotIn(tuple(PASSPHRASE.split()), generated)
+
+class TestSearchPassphrase(unittest.TestCase):
+    def setUp(self):
+        self.kdf_executor = KDFExecutor(processes=2)
+        self.salt = b'salt' * 8
+        token = encrypt_token(b'2-shard1', derive_key(PASSPHRASE, self.salt, 1000))
+        self.envelope = parse_envelope(encode_compact_envelope(self.salt, token, 1000))
+
+    def tearDown(self):
+        self.kdf_executor.close()
+
+    def test_found(self):
+        words = PASSPHRASE.split()
+        words[5], words[6] = words[6], words[5]
+
+        self.assertEqual((PASSPHRASE, b'2-shard1'),
+                         search_passphrase(words, self.envelope, self.kdf_executor))
+
+    def test_not_found(self):
+        words = 'abandon ability able about above absent absorb abstract'.split()
+
+        self.assertIsNone(search_passphrase(words, self.envelope, self.kdf_executor, limit=10))
+
+    def test_candidate_filter(self):
+        words = 'throw theory tunnel soda steel across mix surface'.split()
+        candidate_filter = mock.MagicMock(return_value=False)
+
+        self.assertIsNone(search_passphrase(words, self.envelope, self.kdf_executor,
+                                            limit=10, candidate_filter=candidate_filter))
+        self.assertEqual(10, candidate_filter.call_count)
@@ -1,7 +1,10 @@
+import json
 import unittest
 import mock
 
-from failsafe.utils import _get_input, _print
+from StringIO import StringIO
+
+from failsafe.utils import _get_input, _print, dump_json
 from blessings import Terminal
 term = Terminal()
 
@@ -102,3 +105,29 @@ class TestPrint(unittest.TestCase):
                                           mock.call(term.bold, end=''),
                                           mock.call('item a', 'item b'),
                                           mock.call(term.normal, end='')])
+
+class TestDumpJson(unittest.TestCase):
+    def setUp(self):
+        self.fp = StringIO()
+
+    def test_plain_values(self):
+        data = {'user_key': 'xprv', 'child': '1 of 3', 'count': 2}
+        dump_json(data, self.fp)
+        self.assertEqual(data, json.loads(self.fp.getvalue()))
+
+    def test_generator_values(self):
+        def accounts():
+            for idx in range(3):
+                yield {'wif': 'wif{}'.format(idx), 'address': 'address{}'.format(idx)}
+
+        dump_json({'user_key': 'xprv', 'accounts': accounts()}, self.fp)
+        expected = {'user_key': 'xprv',
+                    'accounts': [{'wif': 'wif0', 'address': 'address0'},
+                                 {'wif': 'wif1', 'address': 'address1'},
+                                 {'wif': 'wif2', 'address': 'address2'},
+                                 ]}
+        self.assertEqual(expected, json.loads(self.fp.getvalue()))
+
+    def test_empty_generator(self):
+        dump_json({'accounts': (x for x in [])}, self.fp)
+        self.assertEqual({'accounts': []}, json.loads(self.fp.getvalue()))
@@ -0,0 +1,32 @@
+import unittest
+
+from failsafe.wordindex import WordIndex, index
+from failsafe.words import wordlist
+
+class TestWordIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = WordIndex(['abandon', 'ability', 'able', 'about', 'zoo'])
+
+    def test_contains(self):
+        self.assertIn('able', self.index)
+        self.assertNotIn('abl', self.index)
+        self.assertEqual(5, len(self.index))
+
+    def test_completions(self):
+        self.assertEqual(['abandon', 'ability', 'able', 'about'], self.index.completions('a'))
+        self.assertEqual(['able'], self.index.completions('abl'))
+        self.assertEqual(['abandon'], self.index.completions('abandon'))
+        self.assertEqual([], self.index.completions('abandons'))
+        self.assertEqual([], self.index.completions('x'))
+
+    def test_resolve(self):
+        self.assertEqual('able', self.index.resolve('able'))
+        self.assertEqual('about', self.index.resolve('abo'))
+        self.assertEqual('abandon', self.index.resolve('abandon'))
+        self.assertIsNone(self.index.resolve('ab'))
+        self.assertIsNone(self.index.resolve('abc'))
+        self.assertIsNone(self.index.resolve(''))
+
+    def test_four_letters_resolve_every_word(self):
+        for word in wordlist:
+            self.assertEqual(word, index.resolve(word[:4]))